@@ -1,11 +1,31 @@
 #!/usr/bin/env python3
 
-from nicegui import html, ui
-import win32print
-import requests
-import base64
+import time
+launch_time = time.perf_counter()  # taken before the imports, for the launch to first usable input measurement
+from fastapi import Request, Response
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from nicegui import app, background_tasks, html, run, ui
+from nicegui.binding import BindableProperty
+import asyncio
+import queue
+import sys
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Iterable, Iterator, TextIO
 import argparse
-from Helpers import strip, validate_input, OutputBarcode
+from Helpers import (strip, parse_unit_numbers, parse_din, group_digits, label_fields, label_zpl, check_din,
+                     DIN_OK, validate_dins, generate_label_chunk, ParsedDIN, OutputBarcode)
+from ZplRenderer import render_zpl_png, ZplRenderError
+from PreviewCache import PreviewCache, preview_key, compact_preview, pillow_available
+from PrintQueue import PrintWorkers, PrinterPool
+from Transports import PartialWriteError, open_transport, raw_printer_name
+from Metrics import registry, stage_seconds, stage_errors, timed, render_prometheus
+from Services import LabelaryService, PrinterDirectory, PreviewError, labelary_responses
+from ScanDetector import ScanBurstDetector
+from PrintJournal import PrintJournal
+from StoredFormats import StoredFormatTracker, stored_format_name, stored_format_zpl, recall_format_zpl
 """
 ISBT 128 provides for unique identification of any donation event
 worldwide. It does this by using a 13-character identifier built from three
@@ -24,224 +44,338 @@ These first 13 characters comprise the Donation Identification Number
 (DIN)
 """
 
+
 # Global Variables
-zpl_code = {'value': ''}
-zpl_preview_image_data: dict[str, str] = {'source': ''}
-ui_images: dict[str, ui.image | None] = {'zpl_preview': None}
-user_input: ui.input | None = None
-printer_select: ui.select | None = None
+# Settings shared by every client; per-client state lives in Session
 debug_mode: bool = False
-debounce_timer: ui.timer | None = None
-debounce_delay: float = 1.0  # seconds
-output_mode_selection: int = 1
-dpmm: str = "8"
-width: str = "3"
-height: str = "1.5"
-check_characters_span: ui.label | None = None
-left_padding: str = "30"
-top_padding: str = "40"
-preview_debounce_timer: ui.timer | None = None
+debounce_delay: float = 1.0  # seconds, for typed input
+scan_debounce_delay: float = 0.0  # seconds, a scanned unit number is complete so its preview is rendered straight away
+auto_print: bool = False  # default for the "Print on scan" switch
+default_left_padding: str = "30"
+default_top_padding: str = "40"
 skip_printing: bool = False
 browser_mode: bool = False
-output_barcode: OutputBarcode | None = None
-output_invalid_barcode: OutputBarcode | None = None
+preview_backend: str = "local"  # "local" renders in-process, "labelary" uses api.labelary.com
+preview_cache: PreviewCache = PreviewCache()
+compact_previews: bool = False  # serve previews downscaled to the display width (needs Pillow)
+compact_preview_cache: PreviewCache = PreviewCache()
+# preview URLs are keyed by a hash of everything the image depends on, so a URL's image never changes
+PREVIEW_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+labelary: LabelaryService = LabelaryService()
+printer_directory: PrinterDirectory = PrinterDirectory()
+use_stored_formats: bool = False
+stored_formats: StoredFormatTracker = StoredFormatTracker()
+# each printer has its own worker and queue, so a station printing to an unreachable printer does not hold up others
+print_workers: PrintWorkers = PrintWorkers(
+    lambda printer_name, debug: open_transport(printer_name, debug or skip_printing), stored_formats=stored_formats)
+printer_pool: PrinterPool = PrinterPool(
+    lambda printer_name, debug: open_transport(printer_name, debug or skip_printing), stored_formats=stored_formats)
+PARTIAL_PRINT_STATUS = 'May be partially printed, check the printer before reprinting'
+POOL_CHUNK_LABELS = 25  # labels per pool job, small enough that a printer failing part way through affects only a few
+print_journal: PrintJournal | None = None
+launch_to_input = registry.gauge('bcprinter_launch_to_input_seconds',
+                                 'Time from launch until the first page was connected and ready for input')
 
-def get_FIN(text: str) -> str:
-    output = strip(text, output_mode_selection)
-    return output[0:5]
+class Session:
+    """State of one connected client (browser tab or desktop window), created by root()"""
+    # the input value once a scan or keystroke has been processed, what the output labels are bound to
+    text = BindableProperty()
 
+    def __init__(self):
+        self.text: str = ''
+        self.scan_detector: ScanBurstDetector = ScanBurstDetector()
+        self.input_handle: asyncio.TimerHandle | None = None
+        self.auto_print: ui.switch | None = None
+        self.reprint_confirmed: str | None = None  # input the operator chose to print again despite the journal
+        self.zpl_code: str = ''
+        self.zpl_preview_source: str = ''
+        self.zpl_preview: ui.image | None = None
+        self.user_input: ui.input | None = None
+        self.printer_select: ui.select | None = None
+        self.pool_switch: ui.switch | None = None
+        self.pool_select: ui.select | None = None
+        self.pool_report: ui.table | None = None
+        self.debounce_timer: asyncio.TimerHandle | None = None
+        self.debounce_started: float | None = None
+        self.preview_debounce_timer: ui.timer | None = None
+        self.preview_generation: int = 0
+        self.preview_task: asyncio.Task | None = None
+        self.output_mode_selection: int = 1
+        self.dpmm: str = "8"
+        self.width: str = "3"
+        self.height: str = "1.5"
+        self.left_padding: str = default_left_padding
+        self.top_padding: str = default_top_padding
+        self.check_characters_span: ui.label | None = None
+        self.output_barcode: OutputBarcode | None = None
+        self.output_invalid_barcode: OutputBarcode | None = None
+        self.batch_input: ui.textarea | None = None
+        self.batch_copies: ui.number | None = None
+        self.batch_collect_scans: ui.switch | None = None
+        self.batch_progress: ui.linear_progress | None = None
+        self.batch_report: ui.table | None = None
 
-def get_year(text: str) -> str:
-    output = strip(text, output_mode_selection)
-    return output[5:7]
+    @property
+    def input_value(self) -> str:
+        return self.user_input.value if self.user_input is not None else ''
 
+def current_din(session: Session, text: str) -> ParsedDIN:
+    return parse_din(text, session.output_mode_selection, session.left_padding, session.top_padding)
 
-def get_sequence_number(text: str) -> str:
-    output = strip(text, output_mode_selection)
-    if len(output) < 13:
-        return output[7:]
-    return output[7:13]
+def get_FIN(session: Session, text: str) -> str:
+    return current_din(session, text).fin
 
-def get_check_characters(text: str) -> str:
-    output = strip(text, output_mode_selection)
-    if len(output) >= 15:
-        return output[13:15]
-    else:
-        return ""
-
-def calc_human_readable_check_character(characters: str) -> str:
-    """Calculate the human readable check character for ISBT 128 barcode"""
-    table = {60: "0", 61: "1", 62: "2", 63: "3", 64: "4", 65: "5", 66: "6", 67: "7", 68: "8", 69: "9",
-             70: "A", 71: "B", 72: "C", 73: "D", 74: "E", 75: "F", 76: "G", 77: "H", 78: "I", 79: "J",
-             80: "K", 81: "L", 82: "M", 83: "N", 84: "O", 85: "P", 86: "Q", 87: "R", 88: "S", 89: "T",
-             90: "U", 91: "V", 92: "W", 93: "X", 94: "Y", 95: "Z", 96: "*"}
-    digits = int(characters)
-    return table[digits]
-
-def format_barcode_string(barcode: str) -> str:
-    barcode = strip(barcode, output_mode_selection)
-    return "{} {} {} {}".format(barcode[:4], barcode[4:7], barcode[7:10], barcode[10:])
-
-def generate_barcode_zpl(barcode: str) -> str:
-    barcode = strip(barcode, output_mode_selection)
-    zpl = "^XA" \
-          "^LH{},{}" \
-          "^BY2,2,100" \
-          "^FO0,0^BC,,N^FD{}^FS".format(left_padding, top_padding, barcode)
-    if output_mode_selection == 2 and len(barcode) >= 15:
-        zpl += ("^FO0,110^A0,40^FD{}  {}^FS" \
-                "^FO300,105^GB55,40,2^FS").format(
-                    format_barcode_string(barcode[:-2]),
-                    calc_human_readable_check_character(barcode[-2:]))
-    elif output_mode_selection == 1:
-        zpl += "^FO0,110^A0,40^FD{}^FS".format(format_barcode_string(barcode))
-    elif output_mode_selection == 3:
-        zpl += "^FO0,110^A0,40^FD{}^FS".format(barcode)
-    zpl += "^XZ"
-    return zpl
-
-def update_user_input(text: str):
-    global output_barcode, output_invalid_barcode, output_mode_selection
-    update_zpl(text)
-    if output_barcode is not None:
-        output_barcode.update(text, output_mode_selection)
-    if output_invalid_barcode is not None:
-        output_invalid_barcode.update(text, output_mode_selection)
-
-def update_zpl(text: str):
-    global zpl_code, ui_images, debounce_timer, output_mode_selection
-    if debounce_timer is not None:
-        debounce_timer.cancel()
-
-    if ui_images['zpl_preview'] is not None and validate_input(text, output_mode_selection):
-        zpl = generate_barcode_zpl(text)
-        zpl_code['value'] = zpl
-        debounce_timer = ui.timer(debounce_delay, labelary_zpl_preview_image, once=True)
-
-
-def update_label_preview_dpmm(value: str):
-    global dpmm, preview_debounce_timer
+
+def get_year(session: Session, text: str) -> str:
+    return current_din(session, text).year
+
+
+def get_sequence_number(session: Session, text: str) -> str:
+    return current_din(session, text).sequence
+
+def get_check_characters(session: Session, text: str) -> str:
+    return current_din(session, text).check_characters
+
+def is_valid_input(session: Session, text: str) -> bool:
+    return current_din(session, text).valid
+
+def format_barcode_string(session: Session, barcode: str) -> str:
+    return group_digits(strip(barcode, session.output_mode_selection))
+
+def generate_print_zpl(session: Session, barcodes: list[str], copies: int = 1) -> tuple[str, dict[str, str]]:
+    """print_zpl for the labels with the session's current output mode and padding"""
+    mode = session.output_mode_selection
+    return print_zpl([strip(barcode, mode) for barcode in barcodes], mode, session.left_padding,
+                     session.top_padding, copies)
+
+def print_zpl(barcodes: list[str], mode: int, left_padding: str, top_padding: str,
+              copies: int = 1) -> tuple[str, dict[str, str]]:
+    """ZPL to print stripped barcodes, as ^XF recalls of a stored format when enabled
+
+    Returns the ZPL and the stored formats it recalls (name -> ^DF download). The print worker sends a
+    download ahead of the job if the printer does not hold the format yet."""
+    if not use_stored_formats:
+        return ''.join(label_zpl(barcode, mode, left_padding, top_padding, copies) for barcode in barcodes), {}
+    zpl = ''
+    formats = {}
+    for barcode in barcodes:
+        fields = label_fields(barcode, mode)
+        layout = "^LH{},{}^BY2,2,100".format(left_padding, top_padding)
+        field_data = []
+        for field, data in fields:
+            if data is None:
+                layout += field + "^FS"
+            else:
+                field_data.append(data)
+                layout += field + "^FN{}^FS".format(len(field_data))
+        name = stored_format_name(layout)
+        formats[name] = stored_format_zpl(name, layout)
+        zpl += recall_format_zpl(name, field_data, copies)
+    return zpl, formats
+
+def handle_input_change(session: Session, text: str):
+    """Process the input once it has been still for a keystroke interval, so a scan is processed once"""
+    session.scan_detector.keystroke()
+    if session.input_handle is not None:
+        session.input_handle.cancel()
+    session.input_handle = asyncio.get_running_loop().call_later(
+        session.scan_detector.key_interval, process_input, session)
+
+def process_input(session: Session):
+    session.input_handle = None
+    if session.user_input is None:
+        return
+    text = session.user_input.value
+    scanned = session.scan_detector.is_scan
+    with session.user_input:
+        update_user_input(session, text, scan_debounce_delay if scanned else debounce_delay)
+        # free text is always valid, so a scan split by a pause would print a label with part of the text
+        if (scanned and session.output_mode_selection in (1, 2) and session.auto_print is not None
+                and session.auto_print.value):
+            handle_key_enter(session)
+
+@timed('update_user_input')
+def update_user_input(session: Session, text: str, delay: float | None = None):
+    session.text = text
+    update_zpl(session, text, delay)
+    din = current_din(session, text)
+    if session.output_barcode is not None:
+        session.output_barcode.update(text, session.output_mode_selection, din)
+    if session.output_invalid_barcode is not None:
+        session.output_invalid_barcode.update(text, session.output_mode_selection, din)
+
+@timed('update_zpl')
+def update_zpl(session: Session, text: str, delay: float | None = None):
+    if delay is None:
+        delay = debounce_delay
+    if session.debounce_timer is not None:
+        session.debounce_timer.cancel()
+        session.debounce_timer = None
+
+    din = current_din(session, text)
+    if session.zpl_preview is not None and din.valid:
+        session.zpl_code = din.zpl
+        session.debounce_started = time.perf_counter()
+        if delay <= 0:
+            refresh_preview(session)
+        else:
+            # a loop callback rather than a ui.timer, which would add and remove an element on every keystroke
+            session.debounce_timer = asyncio.get_running_loop().call_later(delay, refresh_preview, session)
+
+
+def schedule_preview_refresh(session: Session, action):
+    if session.preview_debounce_timer is not None:
+        session.preview_debounce_timer.cancel()
+    session.preview_debounce_timer = ui.timer(debounce_delay, action, once=True)
+
+
+def update_label_preview_dpmm(session: Session, value: str):
     if value.isdigit():
-        dpmm = value
-    if preview_debounce_timer is not None:
-        preview_debounce_timer.cancel()
-    preview_debounce_timer = ui.timer(debounce_delay, labelary_zpl_preview_image, once=True)
+        session.dpmm = value
+    schedule_preview_refresh(session, lambda: refresh_preview(session))
 
 
-def update_label_preview_width(value: str):
-    global width, preview_debounce_timer
+def update_label_preview_width(session: Session, value: str):
     if value.isdigit():
-        width = value
-    if preview_debounce_timer is not None:
-        preview_debounce_timer.cancel()
-    preview_debounce_timer = ui.timer(debounce_delay, labelary_zpl_preview_image, once=True)
+        session.width = value
+    schedule_preview_refresh(session, lambda: refresh_preview(session))
 
 
-def update_label_preview_height(value: str):
-    global height, preview_debounce_timer
+def update_label_preview_height(session: Session, value: str):
     if value.isdigit():
-        height = value
-    if preview_debounce_timer is not None:
-        preview_debounce_timer.cancel()
-    preview_debounce_timer = ui.timer(debounce_delay, labelary_zpl_preview_image, once=True)
+        session.height = value
+    schedule_preview_refresh(session, lambda: refresh_preview(session))
 
 
-def update_left_padding(value: str):
-    global left_padding, preview_debounce_timer
+def update_left_padding(session: Session, value: str):
     if value.isdigit():
-        left_padding = value
-    if preview_debounce_timer is not None:
-        preview_debounce_timer.cancel()
-    preview_debounce_timer = ui.timer(debounce_delay,
-                                      lambda: update_zpl(user_input.value
-                                                         if user_input is not None else ''),
-                                      once=True)
+        session.left_padding = value
+    schedule_preview_refresh(session, lambda: update_zpl(session, session.input_value))
 
 
-def update_right_padding(value: str):
-    global top_padding, preview_debounce_timer
+def update_right_padding(session: Session, value: str):
     if value.isdigit():
-        top_padding = value
-    if preview_debounce_timer is not None:
-        preview_debounce_timer.cancel()
-    preview_debounce_timer = ui.timer(debounce_delay,
-                                      lambda: update_zpl(user_input.value
-                                                         if user_input is not None else ''),
-                                      once=True)
-
-def check_labelary_connection() -> bool:
-    """Check connection to Labelary API"""
-    url = 'http://api.labelary.com/v1/printers/8dpmm/labels/4x2/0/'
-    try:
-        requests.post(url, data='^XA^FO0,0^A0,30^FDTest^FS^XZ', stream=True, timeout=5)
-        return True
-    except requests.exceptions.RequestException:
-        return False
+        session.top_padding = value
+    schedule_preview_refresh(session, lambda: update_zpl(session, session.input_value))
 
-def labelary_zpl_preview_image():
-    global zpl_code, zpl_preview_image_data, ui_images
+async def render_preview_png(zpl: str, dpmm: str, width: str, height: str) -> bytes | None:
+    """Render ZPL to PNG with the configured backend, falling back to Labelary for unsupported ZPL"""
+    if preview_backend == "local":
+        try:
+            return await run.io_bound(render_zpl_png, zpl, dpmm, width, height)
+        except ZplRenderError:
+            pass
+    return await labelary.render_png(zpl, dpmm, width, height)
+
+@timed('labelary_zpl_preview_image')
+async def labelary_zpl_preview_image(session: Session):
     # adjust print density (12dpmm), label width (2 inches), label height (1 inches), and label index (0) as necessary
-    if not zpl_code['value'] is None and len(zpl_code['value']) > 0:
-        url = 'http://api.labelary.com/v1/printers/{}dpmm/labels/{}x{}/0/'.format(dpmm, width, height)
-        response = None
+    if session.zpl_code:
+        session.preview_generation += 1
+        generation = session.preview_generation
+        zpl, render_dpmm, render_width, render_height = session.zpl_code, session.dpmm, session.width, session.height
+        key = preview_key(zpl, render_dpmm, render_width, render_height, preview_backend)
         try:
-            response = requests.post(url, data = zpl_code['value'], stream = True, timeout=5)
-        except requests.exceptions.RequestException:
+            png = await preview_cache.get_or_render_async(
+                key, lambda: render_preview_png(zpl, render_dpmm, render_width, render_height))
+        except PreviewError as e:
+            if generation == session.preview_generation and session.zpl_preview is not None:
+                with session.zpl_preview:
+                    ui.notify(str(e))
             return
-        if response.status_code == 200:
-            base64_image = base64.b64encode(response.content).decode('utf-8')
-            zpl_preview_image_data['source'] = f'data:image/png;base64,{base64_image}'
-            if ui_images['zpl_preview'] is not None:
-                ui_images['zpl_preview'].update()
-        elif response.status_code == 429:
-            ui.notify('Error: Too many requests to Labelary API. Please wait and try again later.')
-        else:
-            ui.notify('Error: ' + response.text)
+        # a newer keystroke or settings change has superseded this render
+        if png is None or generation != session.preview_generation:
+            return
+        # the browser fetches (or reuses from its cache) the image instead of it being pushed over the websocket
+        session.zpl_preview_source = f'/preview/{key}'
+
+def refresh_preview(session: Session):
+    """Start a preview render, cancelling any render still in flight"""
+    session.debounce_timer = None
+    if session.debounce_started is not None:
+        stage_seconds.observe(time.perf_counter() - session.debounce_started, stage='debounce')
+        session.debounce_started = None
+    if session.preview_task is not None and not session.preview_task.done():
+        session.preview_task.cancel()
+    session.preview_task = background_tasks.create(labelary_zpl_preview_image(session), name='label preview')
+
+async def show_preview_if_labelary_reachable(preview_section: ui.element):
+    if await labelary.check_connection():
+        preview_section.set_visibility(True)
 
 
 def get_default_printer():
-    try:
-        return win32print.GetDefaultPrinter()
-    except Exception:
-        return None
+    return printer_directory.default_printer()
 
 def get_printers():
     """Get list of available printers"""
-    # When Name is NULL, setting Flags to PRINTER_ENUM_LOCAL | PRINTER_ENUM_CONNECTIONS enumerates
-    # printers that are installed on the local machine. These printers include those that are
-    # physically attached to the local machine as well as remote printers to which it has a network connection.
-    flags = win32print.PRINTER_ENUM_LOCAL | win32print.PRINTER_ENUM_CONNECTIONS
-    printers = []
-    try:
-        printers = [printer[2] for printer in win32print.EnumPrinters(flags)]
-    except Exception:
-        pass
+    printers = printer_directory.printers()
+    default = get_default_printer()
+    if default is not None and default not in printers:
+        printers.insert(0, default)
     return printers
 
-def zebra_print_zpl(zpl_code: str, printer_name: str):
-    """Send ZPL commands to Zebra printer using Win32 Print Spooler API"""
+async def refresh_printer_select(session: Session):
+    """Fill in the printer list once the printers have been enumerated, keeping the operator's choice"""
+    await printer_directory.refresh_if_stale()
+    if session.printer_select is None:
+        return
+    printers = get_printers()
+    value = session.printer_select.value
+    if value not in printers:
+        value = get_default_printer()
+    session.printer_select.set_options(printers, value=value)
+    if session.pool_select is not None:
+        session.pool_select.set_options(printers, value=[name for name in session.pool_select.value or []
+                                                         if name in printers])
+
+def pool_printers(session: Session) -> list[str] | None:
+    """Printers ticked for the pool, None unless pool mode is on"""
+    if session.pool_switch is None or not session.pool_switch.value or session.pool_select is None:
+        return None
+    return list(session.pool_select.value or []) or None
+
+async def record_launch_to_input(client):
+    """Record how long after launch the first page became usable"""
     try:
-        # Open a handle to the printer
-        hPrinter = win32print.OpenPrinter(printer_name)
-        try:
-            # Start a print job
-            win32print.StartDocPrinter(hPrinter, 1, ("ZPL Print Job", None, "RAW"))
-            try:
-                # Start a page and write the ZPL code
-                # These steps would typically be repeated for multiple pages
-                win32print.StartPagePrinter(hPrinter)
-                win32print.WritePrinter(hPrinter, zpl_code.encode('utf-8'))
-                win32print.EndPagePrinter(hPrinter)
-            finally:
-                win32print.EndDocPrinter(hPrinter)
-        finally:
-            win32print.ClosePrinter(hPrinter)
+        await client.connected()
+    except TimeoutError:
+        return
+    if launch_to_input.value() == 0:
+        launch_to_input.set(time.perf_counter() - launch_time)
+
+def journal_labels(barcodes: Iterable[str], mode: int, left_padding: str, top_padding: str) -> list[tuple[str, str]]:
+    """(barcode, ZPL) pairs to journal for stripped barcodes
+
+    The journal hashes one copy of the full label, so the same label has the same hash whether it was sent whole,
+    as a stored format recall or in a batch with copies."""
+    return [(barcode, label_zpl(barcode, mode, left_padding, top_padding)) for barcode in barcodes]
+
+async def report_print_result(job: Future, client, printer_name: str | None, labels: list[tuple[str, str]],
+                              mode: int):
+    """Notify the result of a print job. printer_name is None for pool jobs, which resolve to the printer used.
+
+    The labels are noted in the journal as queued until the job finishes, then as printed if it succeeded."""
+    try:
+        printed_on = await asyncio.wrap_future(job)
+        if print_journal is not None and labels:
+            print_journal.record_printed(labels, mode, printed_on)
+        message, color = 'Printed!', None
     except Exception as e:
-        raise
+        message, color = f'Print error: {str(e)}', 'negative'
+    finally:
+        if print_journal is not None:
+            print_journal.forget_queued([barcode for barcode, _ in labels], mode)
+    with client:
+        ui.notify(message, color=color)
 
+@timed('send_zpl_to_printer')
+def send_zpl_to_printer(zpl_code, debug=True, printer_name=None, labels: list[tuple[str, str]] = (),
+                        mode: int = 0, formats: dict[str, str] | None = None) -> bool:
+    """Queue ZPL commands for the print worker. Returns True once the job is queued.
 
-def send_zpl_to_printer(zpl_code, debug=True, printer_name=None) -> bool:
-    """Send ZPL commands directly to a printer"""
+    labels are the (barcode, ZPL) pairs in zpl_code, journalled once the job has printed. formats are the
+    stored formats zpl_code recalls."""
     try:
         # Get default printer if none specified
         if printer_name is None:
@@ -249,83 +383,358 @@ def send_zpl_to_printer(zpl_code, debug=True, printer_name=None) -> bool:
             if printer_name is None:
                 ui.notify("Please select a printer!", color='negative')
                 return False
-        if debug or skip_printing:
-            filename = f"{printer_name}.txt"
-            with open(filename, 'w') as f:
-                f.write(zpl_code)
-        else:
-            zebra_print_zpl(zpl_code, printer_name)
-        ui.notify(f'Printed!')
+        job = print_workers.submit(zpl_code, printer_name, debug, formats)
+    except queue.Full:
+        ui.notify('Print queue is full, please wait for the printer to catch up', color='negative')
+        return False
+    if print_journal is not None:
+        print_journal.record_queued([barcode for barcode, _ in labels], mode)
+    background_tasks.create(report_print_result(job, ui.context.client, printer_name, labels, mode),
+                            name='print result')
+    return True
+
+def print_label(session: Session, text: str, debug=True, printer_name=None) -> bool:
+    """Queue the label for text, recalling the printer's stored format when enabled"""
+    if not is_valid_input(session, text):
+        ui.notify('Invalid barcode', color='negative')
+        return False
+    pool = pool_printers(session)
+    if pool:
+        # the job may wait for a printer, so it is built from the settings at the time Enter was pressed
+        mode, left_padding, top_padding = session.output_mode_selection, session.left_padding, session.top_padding
+        barcode = strip(text, mode)
+        zpl, formats = print_zpl([barcode], mode, left_padding, top_padding)
+        job = printer_pool.submit(zpl, 1, pool, debug, formats)
+        if print_journal is not None:
+            print_journal.record_queued([barcode], mode)
+        background_tasks.create(report_print_result(job, ui.context.client, None,
+                                                    journal_labels([barcode], mode, left_padding, top_padding), mode),
+                                name='print result')
         return True
-    except Exception as e:
-        ui.notify(f'Print error: {str(e)}', color='negative')
+    if printer_name is None:
+        printer_name = get_default_printer()
+        if printer_name is None:
+            ui.notify("Please select a printer!", color='negative')
+            return False
+    mode = session.output_mode_selection
+    zpl, formats = generate_print_zpl(session, [text])
+    return send_zpl_to_printer(zpl, debug, printer_name,
+                               journal_labels([strip(text, mode)], mode, session.left_padding, session.top_padding),
+                               mode, formats)
+
+def already_printed(session: Session, text: str) -> bool:
+    """Warn if the journal shows text was printed today or this shift, unless the operator has confirmed"""
+    if print_journal is None or session.reprint_confirmed == text:
         return False
+    printed_at = print_journal.printed_recently(strip(text, session.output_mode_selection),
+                                                session.output_mode_selection)
+    if printed_at is None:
+        return False
+    session.reprint_confirmed = text
+    ui.notify('{} was already printed at {:%H:%M on %d/%m/%Y}. Press Enter or print again to print it anyway.'.format(
+        format_barcode_string(session, text), printed_at), color='warning')
+    return True
 
-def handle_key_enter():
-    global user_input, printer_select, debug_mode, output_mode_selection
-    success = False
-    if user_input is not None and validate_input(user_input.value, output_mode_selection):
-        if printer_select is not None:
-            success = send_zpl_to_printer(zpl_code['value'], debug_mode, printer_select.value)
-        else:
-            success = send_zpl_to_printer(zpl_code['value'])
-        if success:
+def print_input(session: Session):
+    """Print the input's unit number, from Enter or the print button, warning first if it was already printed"""
+    user_input = session.user_input
+    if user_input is None or not is_valid_input(session, user_input.value):
+        return
+    if already_printed(session, user_input.value):
+        return
+    session.reprint_confirmed = None
+    if session.printer_select is not None:
+        success = print_label(session, user_input.value, debug_mode, session.printer_select.value)
+    else:
+        success = print_label(session, user_input.value)
+    if success:
+        user_input.set_value('')
+
+def handle_key_enter(session: Session):
+    user_input = session.user_input
+    if user_input is not None and is_valid_input(session, user_input.value):
+        if session.batch_collect_scans is not None and session.batch_collect_scans.value:
+            add_to_batch(session, user_input.value)
             user_input.set_value('')
+            return
+        print_input(session)
+
+def add_to_batch(session: Session, text: str):
+    if session.batch_input is not None:
+        existing = session.batch_input.value.rstrip('\n')
+        session.batch_input.set_value(existing + '\n' + text if existing else text)
+
+async def load_batch_file(session: Session, event):
+    add_to_batch(session, (await event.file.text()).strip('\n'))
+
+def invalid_reason(unit: str) -> str:
+    """Report status for a unit number the output mode will not print"""
+    status = check_din(strip(unit, 2) or unit).status
+    return 'Invalid barcode ({})'.format(status) if status != DIN_OK else 'Invalid barcode'
+
+def check_batch(session: Session):
+    """Check which unit numbers in the batch box the current output mode would print, without printing"""
+    if session.batch_input is None or session.batch_report is None:
+        return
+    units = parse_unit_numbers(session.batch_input.value)
+    report = validate_dins(units)
+    session.batch_report.rows = [{'id': index, 'unit': unit, 'status': invalid_reason(unit)}
+                                 for index, unit in enumerate(units) if not current_din(session, unit).valid]
+    session.batch_report.update()
+    printable = len(units) - len(session.batch_report.rows)
+    ui.notify(f'{printable} of {len(units)} can be printed in this output mode. {report.valid} verified, '
+              f'{report.unchecked} without check characters, {len(report.malformed)} malformed, '
+              f'{len(report.mismatched)} mismatched',
+              color='positive' if printable == len(units) else 'negative')
+
+async def print_batch(session: Session):
+    """Print every unit number in the batch box and report per-label results
+
+    The labels go to the selected printer as one spool job, or in chunks spread over the printer pool."""
+    batch_progress, batch_report = session.batch_progress, session.batch_report
+    if session.batch_input is None or batch_progress is None or batch_report is None:
+        return
+    pool = pool_printers(session)
+    printer_name = session.printer_select.value if session.printer_select is not None else get_default_printer()
+    if not pool and printer_name is None:
+        ui.notify("Please select a printer!", color='negative')
+        return
+    units = parse_unit_numbers(session.batch_input.value)
+    copies = int(session.batch_copies.value or 1) if session.batch_copies is not None else 1
+    # the settings are read once, the operator may change them while the batch is printing
+    mode, left_padding, top_padding = session.output_mode_selection, session.left_padding, session.top_padding
+    labels = []
+    formats = {}
+    rows = []
+    batch_progress.set_value(0)
+    for index, unit in enumerate(units):
+        din = parse_din(unit, mode, left_padding, top_padding)
+        if din.valid:
+            zpl, label_formats = print_zpl([din.barcode], mode, left_padding, top_padding, copies)
+            formats.update(label_formats)
+            labels.append((din.barcode, zpl, {'id': index, 'unit': unit, 'status': 'Pending', 'printer': ''}))
+            rows.append(labels[-1][2])
+        else:
+            rows.append({'id': index, 'unit': unit, 'status': invalid_reason(unit), 'printer': ''})
+        if index % 100 == 0:
+            # generating is the first half of the progress bar, spooling the second
+            batch_progress.set_value(0.5 * (index + 1) / len(units))
+            await asyncio.sleep(0)
+    batch_progress.set_value(0.5)
+    if labels and pool:
+        await print_batch_on_pool(session, labels, formats, pool, copies, mode, left_padding, top_padding)
+    elif labels:
+        status = 'Printed'
+        barcodes = [barcode for barcode, _, _ in labels]
+        try:
+            job = print_workers.submit(''.join(zpl for _, zpl, _ in labels), printer_name, debug_mode, formats)
+            if print_journal is not None:
+                print_journal.record_queued(barcodes, mode)
+            try:
+                await asyncio.wrap_future(job)
+                if print_journal is not None:
+                    print_journal.record_printed(journal_labels(barcodes, mode, left_padding, top_padding), mode,
+                                                 printer_name)
+            finally:
+                if print_journal is not None:
+                    print_journal.forget_queued(barcodes, mode)
+        except queue.Full:
+            status = 'Print queue is full'
+        except PartialWriteError:
+            # the job is not resent, the operator checks which labels came out before reprinting the rest
+            status = PARTIAL_PRINT_STATUS
+        except Exception as e:
+            status = f'Print error: {str(e)}'
+        for _, _, row in labels:
+            row['status'] = status
+            row['printer'] = printer_name
+    batch_progress.set_value(1)
+    batch_report.rows = rows
+    batch_report.update()
+    printed = sum(1 for row in rows if row['status'] == 'Printed')
+    ui.notify(f'Printed {printed} of {len(rows)} labels',
+              color='positive' if printed == len(rows) else 'negative')
+
+async def print_pool_chunk(job: Future, chunk: list[tuple[str, str, dict]]) -> tuple[list[tuple[str, str, dict]], str]:
+    """Wait for a chunk printed by the pool. Returns the chunk and the printer used, '' if it failed."""
+    try:
+        printer_name = await asyncio.wrap_future(job)
+        status = 'Printed'
+    except PartialWriteError:
+        # the pool does not move a chunk that failed part way through to another printer
+        printer_name = ''
+        status = PARTIAL_PRINT_STATUS
+    except Exception as e:
+        printer_name = ''
+        status = f'Print error: {str(e)}'
+    for _, _, row in chunk:
+        row['status'] = status
+        row['printer'] = printer_name
+    return chunk, printer_name
+
+async def print_batch_on_pool(session: Session, labels: list[tuple[str, str, dict]], formats: dict[str, str],
+                              pool: list[str], copies: int, mode: int, left_padding: str, top_padding: str):
+    """Spread the labels over the pool in chunks and report each printer's throughput for the run
+
+    labels are (stripped barcode, print ZPL, report row) and formats the stored formats they recall. The journal
+    is written from the settings passed in, as the operator may have changed the session's since."""
+    start = time.perf_counter()
+    failures_before = {name: stats['failures'] for name, stats in printer_pool.stats().items()}
+    chunks = []
+    for offset in range(0, len(labels), POOL_CHUNK_LABELS):
+        chunk = labels[offset:offset + POOL_CHUNK_LABELS]
+        job = printer_pool.submit(''.join(zpl for _, zpl, _ in chunk), len(chunk) * copies, pool, debug_mode,
+                                  formats)
+        if print_journal is not None:
+            print_journal.record_queued([barcode for barcode, _, _ in chunk], mode)
+        chunks.append(print_pool_chunk(job, chunk))
+    run_labels: dict[str, int] = {}
+    last_finished: dict[str, float] = {}
+    done = 0
+    for finished in asyncio.as_completed(chunks):
+        chunk, printer_name = await finished
+        barcodes = [barcode for barcode, _, _ in chunk]
+        if printer_name:
+            run_labels[printer_name] = run_labels.get(printer_name, 0) + len(chunk) * copies
+            last_finished[printer_name] = time.perf_counter()
+            if print_journal is not None:
+                print_journal.record_printed(journal_labels(barcodes, mode, left_padding, top_padding), mode,
+                                             printer_name)
+        if print_journal is not None:
+            print_journal.forget_queued(barcodes, mode)
+        done += len(chunk)
+        session.batch_progress.set_value(0.5 + 0.5 * done / len(labels))
+    stats = printer_pool.stats()
+    rows = []
+    for name in pool:
+        printed = run_labels.get(name, 0)
+        rate = printed / (last_finished[name] - start) * 60 if printed else None
+        rows.append({'printer': name, 'labels': printed,
+                     'rate': '{:.0f}'.format(rate) if rate is not None else '-',
+                     'failures': stats.get(name, {}).get('failures', 0) - failures_before.get(name, 0)})
+    if session.pool_report is not None:
+        session.pool_report.rows = rows
+        session.pool_report.set_visibility(True)
+        session.pool_report.update()
+    ui.notify(', '.join('{printer}: {labels} labels ({rate}/min)'.format(**row) for row in rows))
 
-def handle_key(event):
-    global user_input, printer_select
+def handle_key(session: Session, event):
     if event.action.keyup:
         if event.key.enter:
-            handle_key_enter()
+            handle_key_enter(session)
 
 
-def handle_output_mode_change(text: int):
-    global output_mode_selection, user_input, check_characters_span
-    output_mode_selection = text
-    if output_mode_selection == 2 and check_characters_span is not None:
-        check_characters_span.set_text(
-            get_check_characters(user_input.value if user_input is not None else ''))
-    if user_input is not None and len(user_input.value) > 0:
-        temp_input = user_input.value
-        user_input.set_value('')
-        user_input.set_value(temp_input)
-    update_zpl(user_input.value if user_input is not None else '')
+def handle_output_mode_change(session: Session, text: int):
+    session.output_mode_selection = text
+    if session.output_mode_selection == 2 and session.check_characters_span is not None:
+        session.check_characters_span.set_text(get_check_characters(session, session.input_value))
+    user_input = session.user_input
+    if user_input is None:
+        return
+    # the input's validation and everything bound to session.text depend on the mode. Setting the input to the
+    # same value again would be merged by the input debounce and change nothing, so re-publish the text directly.
+    if session.input_handle is not None:
+        session.input_handle.cancel()
+        session.input_handle = None
+    user_input.validate()
+    session.text = ''
+    update_user_input(session, user_input.value)
+
+@app.get('/preview/{key}')
+def preview_image(key: str, request: Request):
+    """Rendered preview images by preview key"""
+    etag = '"{}{}"'.format(key, '-compact' if compact_previews else '')
+    headers = {'ETag': etag, 'Cache-Control': PREVIEW_CACHE_CONTROL}
+    if request.headers.get('if-none-match') == etag:
+        return Response(status_code=304, headers=headers)
+    png = preview_cache.get(key, count=False)
+    if png is None:
+        return Response(status_code=404)
+    if compact_previews:
+        png = compact_preview_cache.get_or_render(key, lambda: compact_preview(png))
+    return Response(png, media_type='image/png', headers=headers)
+
+def local_time(value: datetime) -> datetime:
+    """value as the local time without a time zone, which is how the journal records times"""
+    return value.astimezone().replace(tzinfo=None) if value.tzinfo is not None else value
+
+@app.get('/journal.csv')
+def export_journal(start: str | None = None, end: str | None = None):
+    """Print journal from start up to end (ISO dates or times, default today) as CSV"""
+    if print_journal is None:
+        return Response(status_code=404)
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    try:
+        start_time = local_time(datetime.fromisoformat(start)) if start else today
+        end_time = local_time(datetime.fromisoformat(end)) if end else today + timedelta(days=1)
+    except ValueError:
+        return PlainTextResponse('start and end must be ISO dates, e.g. 2024-01-31', status_code=400)
+    filename = 'print_journal_{:%Y%m%d}-{:%Y%m%d}.csv'.format(start_time, end_time)
+    return StreamingResponse(print_journal.export_csv(start_time, end_time), media_type='text/csv',
+                             headers={'Content-Disposition': f'attachment; filename="{filename}"'})
+
+@app.get('/metrics')
+def metrics():
+    """Prometheus scrape endpoint"""
+    return PlainTextResponse(render_prometheus(), media_type='text/plain; version=0.0.4')
+
+def metrics_overlay_text() -> str:
+    lines = []
+    for stage in ('update_user_input', 'update_zpl', 'debounce', 'labelary_zpl_preview_image', 'labelary',
+                  'send_zpl_to_printer', 'print_queue_wait', 'zebra_print_zpl'):
+        count = stage_seconds.count(stage=stage)
+        if count:
+            lines.append('{}: {} calls, mean {:.1f} ms, {} errors'.format(
+                stage, count, stage_seconds.mean(stage=stage) * 1000, int(stage_errors.value(stage=stage))))
+    lines.append('Labelary 429s: {}'.format(int(labelary_responses.value(status='429'))))
+    lines.append('Print queue depth: {}'.format(print_workers.queue_depth))
+    for name, stats in printer_pool.stats().items():
+        lines.append('Pool {}: {} labels, {} failures{}'.format(
+            name, stats['printed_labels'], stats['failures'], ' (offline)' if stats['offline'] else ''))
+    lines.append('Launch to first input: {:.2f} s'.format(launch_to_input.value()))
+    return '\n'.join(lines)
 
 def root():
-    global zpl_preview_image_data, user_input, printer_select, check_characters_span, output_barcode, output_invalid_barcode
+    session = Session()
     ui.add_head_html('<link href="https://unpkg.com/eva-icons@1.1.3/style/eva-icons.css" rel="stylesheet" />')
     with ui.input(
         placeholder='Unit Number',
-        on_change=lambda e: update_user_input(e.value),
-        validation={'Invalid Barcode': lambda x: x is None or len(x) == 0 or validate_input(x, output_mode_selection)}) as user_input:
-        user_input.on('keydown.enter', handle_key_enter)
+        on_change=lambda e: handle_input_change(session, e.value),
+        validation={'Invalid Barcode': lambda x: x is None or len(x) == 0 or is_valid_input(session, x)}) as user_input:
+        user_input.on('keydown.enter', lambda: handle_key_enter(session))
         user_input.props('clearable autofocus')
         user_input.classes('text-xl')
         ui.icon("edit").props('size=lg')
+    session.user_input = user_input
     output_mode = ui.radio({1: "Cross match", 2: "Full unit number", 3: "Free text"}, value=1,
-                        on_change=lambda e: handle_output_mode_change(e.value))
+                        on_change=lambda e: handle_output_mode_change(session, e.value))
 
     with html.section().style('font-size: 120%'):
         with ui.row():
             output_barcode = OutputBarcode(user_input.value, output_mode.value)
             output_invalid_barcode = OutputBarcode(user_input.value, output_mode.value, show_on_valid_input=False)
+            session.output_barcode = output_barcode
+            session.output_invalid_barcode = output_invalid_barcode
             ui.label("Output Barcode:")
             with html.span().style("--nicegui-default-gap: 0; display: flex;"):
                 ui.label().bind_visibility_from(output_mode, 'value',
                                                 lambda x: x == 3).bind_text_from(
-                                                    user_input, 'value')
+                                                    session, 'text')
             with html.span().style("--nicegui-default-gap: 0; display: flex;").bind_visibility_from(
                     output_barcode, "visible"):
                 with html.span().classes('text-red-500 hover:bg-yellow-300'):
-                    ui.label().bind_text_from(user_input, 'value', get_FIN).tooltip("Facility Identification Number (FIN)")
+                    ui.label().bind_text_from(session, 'text', lambda x: get_FIN(session, x)).tooltip(
+                        "Facility Identification Number (FIN)")
                 with html.span().classes('text-blue-500 hover:bg-yellow-300'):
-                    ui.label().bind_text_from(user_input, 'value', get_year).tooltip("Year")
+                    ui.label().bind_text_from(session, 'text', lambda x: get_year(session, x)).tooltip("Year")
                 with html.span().classes('text-green-500 hover:bg-yellow-300'):
-                    ui.label().bind_text_from(user_input, 'value', get_sequence_number).tooltip("Sequence Number")
+                    ui.label().bind_text_from(session, 'text', lambda x: get_sequence_number(session, x)).tooltip(
+                        "Sequence Number")
                 with html.span().classes('text-purple-500 hover:bg-yellow-300'):
-                    check_characters_span = ui.label().bind_visibility_from(
+                    session.check_characters_span = ui.label().bind_visibility_from(
                         output_mode, 'value', lambda x: x == 2).bind_text_from(
-                            user_input, 'value', get_check_characters).tooltip("Check Characters")
+                            session, 'text', lambda x: get_check_characters(session, x)).tooltip(
+                                "Check Characters")
 
             invalid_barcode_label = ui.label("Invalid barcode").style("color:red;")
             invalid_barcode_label.bind_visibility_from(output_invalid_barcode, "visible")
@@ -339,56 +748,102 @@ def root():
         padding-right: 5px !important;
     } 
     ''')
-    has_connection = check_labelary_connection()
-    if has_connection:
+    # The Labelary probe runs in the background so it does not hold up the page load
+    with ui.column().classes('gap-1') as preview_section:
+        preview_section.set_visibility(preview_backend == "local")
+        if preview_backend == "labelary":
+            ui.timer(0, lambda: show_preview_if_labelary_reachable(preview_section), once=True)
         ui.label("Label Preview:").style('font-size: 120%')
         with ui.expansion("Preview settings", icon="settings").classes('text-xs nicegui-expansion').props('dense'):
             with html.span().style('display: flex; gap: 10px; align-items: center;'):
                 ui.input(label="dpmm",
                         placeholder="8",
                         value="8",
-                        on_change=lambda x: update_label_preview_dpmm(x.value)).props(
+                        on_change=lambda x: update_label_preview_dpmm(session, x.value)).props(
                             "type=number dense").classes('w-10')
                 ui.input(label="width (inches)",
                         placeholder="3",
                         value="3",
-                        on_change=lambda x: update_label_preview_width(x.value)).props(
+                        on_change=lambda x: update_label_preview_width(session, x.value)).props(
                             "type=number dense").classes('w-20')
                 ui.input(label="height (inches)",
                         placeholder="1.5",
                         value="1.5",
-                        on_change=lambda x: update_label_preview_height(x.value)).props(
+                        on_change=lambda x: update_label_preview_height(session, x.value)).props(
                             "type=number dense").classes('w-20')
         zpl_preview = ui.image().style('width: 300px; height: auto; border: 1px solid black;')
-        ui_images['zpl_preview'] = zpl_preview
-        zpl_preview.bind_source_from(zpl_preview_image_data)
+        session.zpl_preview = zpl_preview
+        zpl_preview.bind_source_from(session, 'zpl_preview_source')
+        if debug_mode:
+            ui.label().classes('text-xs').bind_text_from(
+                session, 'zpl_preview_source',
+                lambda _: 'Preview cache: {hits} hits ({disk_hits} from disk), {misses} misses, '
+                          '~{saved_seconds:.2f}s saved'.format(**preview_cache.stats()))
     with ui.expansion("Print settings", icon="settings").classes('text-xs nicegui-expansion').props('dense'):
         with html.span().style('display: flex; gap: 10px; align-items: center;'):
             ui.input(label="Left padding (dpmm)",
-                     placeholder="30",
-                     value="30",
-                     on_change=lambda x: update_left_padding(x.value)).props(
+                     placeholder=default_left_padding,
+                     value=default_left_padding,
+                     on_change=lambda x: update_left_padding(session, x.value)).props(
                          "type=number dense").classes('w-30')
             ui.input(label="Top padding (dpmm)",
-                     placeholder="40",
-                     value="40",
-                     on_change=lambda x: update_right_padding(x.value)).props(
+                     placeholder=default_top_padding,
+                     value=default_top_padding,
+                     on_change=lambda x: update_right_padding(session, x.value)).props(
                          "type=number dense").classes('w-30')
-    printers = get_printers()
-    default = get_default_printer()
-    if default is not None and default not in printers:
-        printers.insert(0, default)
-    printer_select_local: ui.select = ui.select(printers,
+        session.auto_print = ui.switch('Print on scan', value=auto_print).tooltip(
+            "Print as soon as a valid unit number is scanned, for scanners that do not send Enter. "
+            "Not used in Free text mode.")
+    # the page is built from the cached printer list, the select is updated when a refresh finishes
+    printer_select: ui.select = ui.select(get_printers(),
                                label='Select Printer',
-                               value=default)
-    printer_select = printer_select_local
-    with ui.button(icon="print",
-                   on_click=lambda: send_zpl_to_printer(zpl_code[
-                       'value'], debug_mode, printer_select_local.value)) as print_button:
+                               value=get_default_printer())
+    session.printer_select = printer_select
+    with html.span().style('display: flex; gap: 10px; align-items: center;'):
+        session.pool_switch = ui.switch('Printer pool').tooltip(
+            "Spread printing over several printers, moving jobs off a printer that fails")
+        session.pool_select = ui.select(get_printers(), multiple=True, label='Pool printers', value=[]).props(
+            'use-chips dense').classes('min-w-[200px]')
+        session.pool_select.bind_visibility_from(session.pool_switch, 'value')
+    printer_select.bind_visibility_from(session.pool_switch, 'value', lambda x: not x)
+    if printer_directory.stale:
+        background_tasks.create(refresh_printer_select(session), name='printer list')
+    if launch_to_input.value() == 0:
+        background_tasks.create(record_launch_to_input(ui.context.client), name='launch to input')
+    with ui.button(icon="print", on_click=lambda: print_input(session)) as print_button:
         print_button.props("size=xl")
-        print_button.bind_enabled_from(user_input, 'value', lambda x: validate_input(x, output_mode_selection))
+        print_button.bind_enabled_from(session, 'text', lambda x: is_valid_input(session, x))
         ui.tooltip("Print (shortcut key: Enter)").classes('text-xs')
-    ui.keyboard(on_key=handle_key)
+    with ui.expansion("Batch print", icon="list").classes('text-xs nicegui-expansion w-full').props('dense'):
+        with ui.column().classes('w-full gap-1'):
+            session.batch_input = ui.textarea(label='Unit numbers (one per line)').props('dense').classes('w-full')
+            with html.span().style('display: flex; gap: 10px; align-items: center;'):
+                session.batch_copies = ui.number(label='Copies', value=1, min=1, precision=0).props(
+                    'dense').classes('w-20')
+                session.batch_collect_scans = ui.switch('Add scans to batch')
+            ui.upload(label='Load CSV/text file', auto_upload=True,
+                      on_upload=lambda e: load_batch_file(session, e)).props(
+                'dense accept=".csv,.txt"').classes('w-full')
+            with ui.row():
+                ui.button('Check', icon='fact_check', on_click=lambda: check_batch(session)).props('outline')
+                ui.button('Print batch', icon='print', on_click=lambda: print_batch(session))
+            session.batch_progress = ui.linear_progress(value=0, show_value=False)
+            session.batch_report = ui.table(columns=[{'name': 'unit', 'label': 'Unit', 'field': 'unit'},
+                                                     {'name': 'status', 'label': 'Status', 'field': 'status'},
+                                                     {'name': 'printer', 'label': 'Printer', 'field': 'printer'}],
+                                            rows=[], row_key='id').props('dense').classes('w-full')
+            session.pool_report = ui.table(columns=[
+                {'name': 'printer', 'label': 'Printer', 'field': 'printer'},
+                {'name': 'labels', 'label': 'Labels', 'field': 'labels'},
+                {'name': 'rate', 'label': 'Labels/min', 'field': 'rate'},
+                {'name': 'failures', 'label': 'Failures', 'field': 'failures'}],
+                rows=[], row_key='printer', title='Printer pool').props('dense').classes('w-full')
+            session.pool_report.set_visibility(False)
+    ui.keyboard(on_key=lambda e: handle_key(session, e))
+    if debug_mode:
+        metrics_overlay = ui.label().classes('fixed top-1 right-1 text-xs bg-yellow-100 p-1 opacity-80').style(
+            'white-space: pre; pointer-events: none;')
+        ui.timer(1.0, lambda: metrics_overlay.set_text(metrics_overlay_text()))
     dark = ui.dark_mode()
     ui.switch('Dark Mode').classes("fixed bottom-5 right-1").bind_value(dark)
     ui.icon(name="eva-github", size="sm").classes("fixed bottom-1 right-1").style("cursor: pointer;").on(
@@ -402,23 +857,172 @@ def parse_args():
         action='store_true',
         help='skip printing (outputs to file instead). Enabled in debug mode automatically.')
     parser.add_argument('-b', "--browser", action='store_true', help='launch in browser instead of desktop app')
+    parser.add_argument(
+        '--preview-backend',
+        choices=['local', 'labelary'],
+        default='local',
+        help='render label previews locally (default) or with the Labelary API. '
+             'The local renderer falls back to Labelary for ZPL it does not support.')
+    parser.add_argument('-p', '--network-printer', action='append', default=[], metavar='HOST[:PORT]',
+                        help='add a Zebra printer reached directly over raw TCP (port 9100 by default). '
+                             'Can be given more than once.')
+    parser.add_argument('--auto-print', action='store_true',
+                        help='print a label as soon as a valid unit number is scanned, without waiting for Enter '
+                             '(not in Free text mode)')
+    parser.add_argument('--journal', default='print_journal.tsv', metavar='PATH',
+                        help='append-only record of every printed label (default: print_journal.tsv). '
+                             'An empty path turns the journal off.')
+    parser.add_argument('--shift-hours', type=float, default=12.0,
+                        help='warn before reprinting a unit number printed today or within this many hours '
+                             '(default: 12)')
+    parser.add_argument('--stored-formats', action='store_true',
+                        help='download the label layout to each printer once as a stored format (^DF) '
+                             'and send only the field data (^XF) for each label')
+    parser.add_argument('--preview-cache-size', type=int, default=256,
+                        help='number of preview images kept in memory (default: 256)')
+    parser.add_argument('--preview-cache-dir', default=None,
+                        help='directory to persist preview images in across restarts')
+    parser.add_argument('--preview-cache-dir-size', type=int, default=4096,
+                        help='number of preview images kept in --preview-cache-dir, the least recently used are '
+                             'deleted first (default: 4096)')
+    parser.add_argument('--compact-previews', action='store_true',
+                        help='send previews to the browser downscaled to the width they are displayed at (needs Pillow)')
+    headless = parser.add_argument_group('headless mode', 'generate ZPL from a stream of unit numbers without the GUI')
+    headless.add_argument('--headless', action='store_true', help='run without the GUI')
+    headless.add_argument('-i', '--input', default='-',
+                          help='file of unit numbers, one per line or first CSV column (default: stdin)')
+    headless.add_argument('-o', '--output', default='-', help='file to write the ZPL to (default: stdout)')
+    headless.add_argument('--print-to', metavar='PRINTER', default=None,
+                          help='send the ZPL to this printer (a Windows printer name or tcp://host:port) '
+                               'instead of writing it out')
+    headless.add_argument('--mode', type=int, choices=[1, 2, 3], default=1,
+                          help='output mode: 1 cross match (default), 2 full unit number, 3 free text')
+    headless.add_argument('--left-padding', default=default_left_padding, help='left padding in dots')
+    headless.add_argument('--top-padding', default=default_top_padding, help='top padding in dots')
+    headless.add_argument('--copies', type=int, default=1, help='copies of each label')
+    headless.add_argument('-j', '--jobs', type=int, default=1, help='worker processes generating ZPL (default: 1)')
+    headless.add_argument('--chunk-size', type=int, default=1000, help='unit numbers per worker task')
     return parser.parse_known_args()[0]
 
+def read_unit_numbers(stream: TextIO, line_numbers: deque | None = None) -> Iterator[str]:
+    """Unit numbers in stream, skipping blank lines. The line number of each is appended to line_numbers."""
+    for number, line in enumerate(stream, 1):
+        unit = line.split(',', 1)[0].strip()
+        if unit:
+            if line_numbers is not None:
+                line_numbers.append(number)
+            yield unit
+
+def chunked(units: Iterable[str], size: int) -> Iterator[list[str]]:
+    chunk = []
+    for unit in units:
+        chunk.append(unit)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def generate_labels(units: Iterable[str], mode: int, left: str, top: str, copies: int = 1,
+                    jobs: int = 1, chunk_size: int = 1000) -> Iterator[list[tuple[str, str | None]]]:
+    """Yield chunks of (unit, ZPL) in input order, keeping at most 2 chunks per worker in flight"""
+    chunks = chunked(units, chunk_size)
+    if jobs <= 1:
+        for chunk in chunks:
+            yield generate_label_chunk(chunk, mode, left, top, copies)
+        return
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        in_flight: deque = deque()
+        for chunk in chunks:
+            in_flight.append(executor.submit(generate_label_chunk, chunk, mode, left, top, copies))
+            if len(in_flight) >= jobs * 2:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
+
+def run_headless(args) -> int:
+    """Stream unit numbers through strip/validate_input/generate ZPL to a file, stdout or a printer"""
+    transport = None
+    sink = None
+    if args.print_to is not None:
+        try:
+            transport = open_transport(args.print_to, skip_printing)
+        except OSError as e:
+            print(f'Cannot print to {args.print_to}: {e}', file=sys.stderr)
+            return 2
+    source = sys.stdin if args.input == '-' else open(args.input, newline='')
+    if transport is None:
+        sink = sys.stdout if args.output == '-' else open(args.output, 'w')
+    invalid = 0
+    # labels come back in input order, so the line numbers are taken off the front as they are reported
+    line_numbers = deque()
+    try:
+        for chunk in generate_labels(read_unit_numbers(source, line_numbers), args.mode, args.left_padding,
+                                     args.top_padding, args.copies, args.jobs, args.chunk_size):
+            zpl = []
+            for unit, label in chunk:
+                line = line_numbers.popleft()
+                if label is None:
+                    invalid += 1
+                    print(f'{line}: invalid barcode {unit!r}', file=sys.stderr)
+                else:
+                    zpl.append(label)
+            if transport is not None:
+                try:
+                    transport.write(''.join(zpl))
+                except OSError as e:
+                    print(f'Cannot print to {args.print_to}: {e}', file=sys.stderr)
+                    return 2
+            else:
+                sink.write(''.join(zpl))
+    finally:
+        if transport is not None:
+            transport.close()
+        if sink is not None and sink is not sys.stdout:
+            sink.close()
+        if source is not sys.stdin:
+            source.close()
+    return 1 if invalid else 0
+
 # Main
-args = parse_args()
-if args.debug:
-    debug_mode = True
-    skip_printing = True
-if args.skip_printing:
-    skip_printing = True
-if args.browser:
-    browser_mode = True
-
-window_size=(500, 800)
-if debug_mode or browser_mode:
-    window_size = None
-ui.run(root=root,
-       title="Royal Papworth Hospital Barcode Printing Ver (2.3.0)",
-       window_size=window_size,
-       favicon="🖨️",
-       reload=debug_mode)
+# __mp_main__ is the module name in reload and worker processes
+if __name__ in {"__main__", "__mp_main__"}:
+    args = parse_args()
+    if args.debug:
+        debug_mode = True
+        skip_printing = True
+    if args.skip_printing:
+        skip_printing = True
+    if args.headless:
+        # headless worker processes re-import this module, only the parent runs the pipeline
+        if __name__ == "__main__":
+            sys.exit(run_headless(args))
+    else:
+        if args.browser:
+            browser_mode = True
+        preview_backend = args.preview_backend
+        printer_directory = PrinterDirectory([raw_printer_name(address) for address in args.network_printer])
+        use_stored_formats = args.stored_formats
+        auto_print = args.auto_print
+        if args.journal:
+            print_journal = PrintJournal(args.journal, args.shift_hours)
+        preview_cache = PreviewCache(args.preview_cache_size, args.preview_cache_dir,
+                                     args.preview_cache_dir_size)
+        compact_preview_cache = PreviewCache(args.preview_cache_size)
+        if args.compact_previews and not pillow_available():
+            print('Pillow is not installed, previews are sent as full size PNGs', file=sys.stderr)
+        compact_previews = args.compact_previews and pillow_available()
+        # enumerate the printers while the UI starts, so the first page already has the full list
+        threading.Thread(target=printer_directory.refresh, name='printer list', daemon=True).start()
+        app.on_shutdown(labelary.close)
+        app.on_shutdown(print_workers.stop)
+        app.on_shutdown(printer_pool.stop)
+
+        window_size=(500, 800)
+        if debug_mode or browser_mode:
+            window_size = None
+        ui.run(root=root,
+               title="Royal Papworth Hospital Barcode Printing Ver (2.3.0)",
+               window_size=window_size,
+               favicon="🖨️",
+               reload=debug_mode)
@@ -1,3 +1,9 @@
+import csv
+import re
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Iterable, Iterator
+
 def strip(text: str, output_mode_selection: int) -> str:
     if text is None or (output_mode_selection <= 2 and len(text) < 13):
         return ""
@@ -17,27 +23,200 @@ def validate_input(text: str, mode: int = 0) -> bool:
     if text is None:
         return False
     if mode == 1:
-        return len(strip(text, mode)) >= 13
+        if len(strip(text, mode)) < 13:
+            return False
+        # the label only shows the DIN, but a scan with the check character flags is verified so that a
+        # mis-keyed unit is not printed
+        barcode = strip(text, 2)
+        if len(barcode) < 15 or not barcode[13:15].isdigit():
+            return True
+        return check_din(barcode).status in (DIN_OK, DIN_NO_CHECK)
     elif mode == 2:
-        return len(strip(text, mode)) >= 15 and text[-2:].isdigit() and int(text[-2:]) >= 20
+        barcode = strip(text, mode)
+        return len(barcode) >= 15 and check_din(barcode).status == DIN_OK
     elif mode == 3:
         return True
 
+# ISO 7064 MOD 37-2 check characters, indexed by check value
+CHECK_CHARACTERS = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ*"
+# Flag characters 60-96 carry the check character in the barcode (60 = "0" ... 96 = "*")
+CHECK_FLAG_OFFSET = 60
+DIN_LENGTH = 13
+DIN_PATTERN = re.compile(r"[A-Z0-9][0-9]{12}([0-9]{2})?")
+# weighted value of every character at every DIN position: value * 2^(13 - position) mod 37
+_WEIGHTED_VALUES = tuple(
+    {char: value * pow(2, DIN_LENGTH - position, 37) % 37 for value, char in enumerate(CHECK_CHARACTERS[:36])}
+    for position in range(DIN_LENGTH))
+
+def calc_check_character(din: str) -> str:
+    """ISO 7064 MOD 37-2 check character of a 13 character DIN"""
+    total = 0
+    for weighted, char in zip(_WEIGHTED_VALUES, din):
+        total += weighted[char]
+    return CHECK_CHARACTERS[(38 - total % 37) % 37]
+
+def calc_human_readable_check_character(characters: str) -> str:
+    """Calculate the human readable check character for ISBT 128 barcode flag characters (60-96)"""
+    if not characters.isdigit() or not 0 <= int(characters) - CHECK_FLAG_OFFSET < len(CHECK_CHARACTERS):
+        return ""
+    return CHECK_CHARACTERS[int(characters) - CHECK_FLAG_OFFSET]
+
+DIN_OK = "ok"
+DIN_MALFORMED = "malformed"
+DIN_NO_CHECK = "no check character"
+DIN_MISMATCH = "check character mismatch"
+
+@dataclass(frozen=True, slots=True)
+class DINCheck:
+    text: str
+    status: str
+    expected: str = ""
+    found: str = ""
+
+def check_din(text: str) -> DINCheck:
+    """Verify a DIN, with or without its leading '=' and the two flag characters after it"""
+    din = text[1:] if text[:1] == '=' else text
+    if DIN_PATTERN.fullmatch(din) is None:
+        return DINCheck(text, DIN_MALFORMED)
+    expected = calc_check_character(din[:DIN_LENGTH])
+    flags = din[DIN_LENGTH:]
+    if flags == "" or int(flags) < CHECK_FLAG_OFFSET:
+        return DINCheck(text, DIN_NO_CHECK, expected)
+    found = calc_human_readable_check_character(flags)
+    if found == "":
+        return DINCheck(text, DIN_MALFORMED, expected)  # flags 97-99 are neither a check character nor a flag
+    return DINCheck(text, DIN_OK if found == expected else DIN_MISMATCH, expected, found)
+
+@dataclass(slots=True)
+class DINBatchReport:
+    total: int = 0
+    valid: int = 0
+    unchecked: int = 0
+    malformed: list[DINCheck] = field(default_factory=list)
+    mismatched: list[DINCheck] = field(default_factory=list)
+
+def check_dins(units: Iterable[str]) -> Iterator[DINCheck]:
+    for unit in units:
+        yield check_din(unit.strip())
+
+def validate_dins(units: Iterable[str]) -> DINBatchReport:
+    """Check many DINs in one pass. Only the malformed and mismatched ones are kept in the report."""
+    report = DINBatchReport()
+    for result in check_dins(units):
+        report.total += 1
+        if result.status == DIN_OK:
+            report.valid += 1
+        elif result.status == DIN_NO_CHECK:
+            report.unchecked += 1
+        elif result.status == DIN_MALFORMED:
+            report.malformed.append(result)
+        else:
+            report.mismatched.append(result)
+    return report
+
+def validate_din_file(path: str) -> DINBatchReport:
+    """Check every DIN in a text/CSV file (first column), streaming it line by line"""
+    with open(path, newline='') as f:
+        return validate_dins(row[0] for row in csv.reader(f) if row and row[0].strip())
+
+def group_digits(barcode: str) -> str:
+    """Space out a stripped barcode for the human readable line, e.g. G151 723 600 001"""
+    return "{} {} {} {}".format(barcode[:4], barcode[4:7], barcode[7:10], barcode[10:])
+
+def human_readable_text(barcode: str, output_mode_selection: int) -> str:
+    """Text printed under the barcode for a stripped barcode"""
+    if output_mode_selection == 2 and len(barcode) >= 15:
+        return "{}  {}".format(group_digits(barcode[:-2]), calc_human_readable_check_character(barcode[-2:]))
+    elif output_mode_selection == 1:
+        return group_digits(barcode)
+    elif output_mode_selection == 3:
+        return barcode
+    return ""
+
+def label_fields(barcode: str, output_mode_selection: int) -> list[tuple[str, str | None]]:
+    """(field ZPL, field data) for each field on the label. Fields without data are static graphics."""
+    fields: list[tuple[str, str | None]] = [("^FO0,0^BC,,N", barcode)]
+    if output_mode_selection in (1, 3) or (output_mode_selection == 2 and len(barcode) >= 15):
+        fields.append(("^FO0,110^A0,40", human_readable_text(barcode, output_mode_selection)))
+    if output_mode_selection == 2 and len(barcode) >= 15:
+        fields.append(("^FO300,105^GB55,40,2", None))
+    return fields
+
+def label_zpl(barcode: str, output_mode_selection: int, left_padding: str, top_padding: str,
+              copies: int = 1) -> str:
+    zpl = "^XA" \
+          "^LH{},{}" \
+          "^BY2,2,100".format(left_padding, top_padding)
+    for field, data in label_fields(barcode, output_mode_selection):
+        zpl += field + ("^FD{}".format(data) if data is not None else "") + "^FS"
+    if copies > 1:
+        zpl += "^PQ{}".format(copies)
+    zpl += "^XZ"
+    return zpl
+
+@dataclass(frozen=True, slots=True)
+class ParsedDIN:
+    """A unit number parsed once for an output mode and padding, shared by every UI binding"""
+    barcode: str
+    fin: str
+    year: str
+    sequence: str
+    check_characters: str
+    valid: bool
+    text: str
+    zpl: str
+
+@lru_cache(maxsize=1024)
+def parse_din(text: str, output_mode_selection: int, left_padding: str = "30", top_padding: str = "40") -> ParsedDIN:
+    barcode = strip(text, output_mode_selection)
+    valid = bool(validate_input(text, output_mode_selection))
+    return ParsedDIN(
+        barcode=barcode,
+        fin=barcode[0:5],
+        year=barcode[5:7],
+        sequence=barcode[7:13],
+        check_characters=barcode[13:15] if len(barcode) >= 15 else "",
+        valid=valid,
+        text=human_readable_text(barcode, output_mode_selection) if valid else "",
+        zpl=label_zpl(barcode, output_mode_selection, left_padding, top_padding) if valid else "")
+
+def generate_label_chunk(units: list[str], output_mode_selection: int, left_padding: str, top_padding: str,
+                         copies: int = 1) -> list[tuple[str, str | None]]:
+    """(unit, ZPL) for each unit, with None as the ZPL for invalid units. Runs in worker processes."""
+    labels = []
+    for unit in units:
+        if validate_input(unit, output_mode_selection):
+            labels.append((unit, label_zpl(strip(unit, output_mode_selection), output_mode_selection,
+                                           left_padding, top_padding, copies)))
+        else:
+            labels.append((unit, None))
+    return labels
+
+def parse_unit_numbers(text: str) -> list[str]:
+    """Split pasted text or CSV/text file contents into unit numbers, taking the first cell of each row"""
+    units = []
+    for row in csv.reader(text.splitlines()):
+        cells = [cell.strip() for cell in row if cell.strip()]
+        if cells:
+            units.append(cells[0])
+    return units
+
 class OutputBarcode:
     def __init__(self, user_input: str, output_mode_selection: int, show_on_valid_input: bool = True):
         self.user_input = user_input
         self.output_mode_selection = output_mode_selection
         self.show_on_valid_input = show_on_valid_input
+        self.din: ParsedDIN | None = None
         self.visible: bool = False
 
     def set_visibility(self) -> None:
         self.visible = self.output_mode_selection <= 2 and self.user_input is not None and len(self.user_input) > 0
-        if self.show_on_valid_input:
-            self.visible = self.visible and validate_input(self.user_input, self.output_mode_selection)
-        else:
-            self.visible = self.visible and not validate_input(self.user_input, self.output_mode_selection)
+        if self.visible:
+            din = self.din if self.din is not None else parse_din(self.user_input, self.output_mode_selection)
+            self.visible = din.valid if self.show_on_valid_input else not din.valid
     
-    def update(self, user_input: str, output_mode_selection: int):
+    def update(self, user_input: str, output_mode_selection: int, din: ParsedDIN | None = None):
         self.user_input = user_input
         self.output_mode_selection = output_mode_selection
+        self.din = din
         self.set_visibility()
\ No newline at end of file
@@ -0,0 +1,154 @@
+"""
+Minimal in-process metrics with Prometheus text exposition.
+
+Counters, gauges and histograms are registered by name and rendered by
+render_prometheus() for the /metrics route. timed() records the duration of
+a block or function call into a histogram and counts its errors.
+"""
+import bisect
+import functools
+import inspect
+import threading
+import time
+from contextlib import contextmanager
+
+# seconds, from a local render up to a slow Labelary response or spooler
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self.values.get(tuple(sorted(labels.items())), 0.0)
+
+    def samples(self) -> list[tuple[str, tuple, float]]:
+        with self.lock:
+            return [(self.name, key, value) for key, value in self.values.items()]
+
+
+class Gauge(Counter):
+    def set(self, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counts: dict[tuple, list[int]] = {}
+        self.sums: dict[tuple, float] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counts = self.counts.setdefault(key, [0] * (len(self.buckets) + 1))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.sums[key] = self.sums.get(key, 0.0) + value
+
+    def count(self, **labels: str) -> int:
+        return sum(self.counts.get(tuple(sorted(labels.items())), []))
+
+    def mean(self, **labels: str) -> float:
+        key = tuple(sorted(labels.items()))
+        count = sum(self.counts.get(key, []))
+        return self.sums.get(key, 0.0) / count if count else 0.0
+
+    def samples(self) -> list[tuple[str, tuple, float]]:
+        samples = []
+        with self.lock:
+            for key, counts in self.counts.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    samples.append((self.name + '_bucket', key + (('le', le),), cumulative))
+                samples.append((self.name + '_sum', key, self.sums[key]))
+                samples.append((self.name + '_count', key, cumulative))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: dict[str, Counter | Histogram] = {}
+
+    def _get(self, cls, name: str, help: str):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(name, help)
+        return metric
+
+    def counter(self, name: str, help: str = '') -> Counter:
+        return self._get(Counter, name, help)
+
+    def gauge(self, name: str, help: str = '') -> Gauge:
+        return self._get(Gauge, name, help)
+
+    def histogram(self, name: str, help: str = '') -> Histogram:
+        return self._get(Histogram, name, help)
+
+
+registry = Registry()
+stage_seconds = registry.histogram('bcprinter_stage_seconds', 'Time spent in each stage of the scan-to-label path')
+stage_errors = registry.counter('bcprinter_stage_errors_total', 'Exceptions raised by each stage')
+
+
+@contextmanager
+def measure(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        stage_errors.inc(stage=stage)
+        raise
+    finally:
+        stage_seconds.observe(time.perf_counter() - start, stage=stage)
+
+
+def timed(stage: str):
+    """Decorator recording the duration (and errors) of every call, for plain and async functions"""
+    def decorator(function):
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                with measure(stage):
+                    return await function(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with measure(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ''
+    escaped = ('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in labels)
+    return '{' + ','.join(escaped) + '}'
+
+
+def render_prometheus() -> str:
+    lines = []
+    for metric in registry.metrics.values():
+        kind = 'histogram' if isinstance(metric, Histogram) else 'gauge' if isinstance(metric, Gauge) else 'counter'
+        lines.append('# HELP {} {}'.format(metric.name, metric.help))
+        lines.append('# TYPE {} {}'.format(metric.name, kind))
+        for name, labels, value in metric.samples():
+            lines.append('{}{} {}'.format(name, _format_labels(labels), repr(float(value))))
+    return '\n'.join(lines) + '\n'
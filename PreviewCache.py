@@ -0,0 +1,220 @@
+"""
+Content-addressed cache for rendered label previews.
+
+Images are keyed by a hash of the ZPL and the render parameters. Recently used
+images are kept in a bounded in-memory LRU, and optionally written to a
+directory so they survive restarts. The directory is bounded too, the least
+recently used files are deleted first. Concurrent async requests for the same
+key share a single render.
+
+compact_preview() shrinks an image to the width it is displayed at. It needs
+Pillow, which is optional.
+"""
+import asyncio
+import hashlib
+import importlib.util
+import io
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable
+
+# width of the preview image in the page, in CSS pixels
+PREVIEW_DISPLAY_WIDTH = 300
+
+
+def preview_key(zpl: str, *params: object) -> str:
+    """Hash the ZPL text together with the render parameters (dpmm, width, height, backend, ...)"""
+    digest = hashlib.sha256(zpl.encode('utf-8'))
+    for param in params:
+        digest.update(b'\0' + str(param).encode('utf-8'))
+    return digest.hexdigest()
+
+
+# labels are black on white, 4 shades keep the edges of the downscaled barcode smooth
+COMPACT_PREVIEW_SHADES = 4
+
+
+def pillow_available() -> bool:
+    # without Pillow previews are served as full size PNGs
+    return importlib.util.find_spec('PIL') is not None
+
+
+def compact_preview(png: bytes, width: int = PREVIEW_DISPLAY_WIDTH) -> bytes:
+    """Downscale a PNG preview to width pixels as a few-shade palette PNG, if that is smaller"""
+    # imported on first use, Pillow is optional and only needed for --compact-previews
+    from PIL import Image
+    with Image.open(io.BytesIO(png)) as image:
+        if image.width > width:
+            image = image.resize((width, round(image.height * width / image.width)), Image.LANCZOS)
+        output = io.BytesIO()
+        image.convert('L').quantize(COMPACT_PREVIEW_SHADES).save(output, 'PNG', optimize=True)
+    compact = output.getvalue()
+    return compact if len(compact) < len(png) else png
+
+
+class PendingRender:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters: int = 0
+        self.abandoned: bool = False
+
+
+class PreviewCache:
+    def __init__(self, max_entries: int = 256, cache_dir: str | None = None, max_disk_entries: int = 4096):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.max_disk_entries = max_disk_entries
+        self.entries: OrderedDict[str, bytes] = OrderedDict()
+        self.disk_entries: OrderedDict[str, None] = OrderedDict()  # keys on disk, least recently used first
+        self.lock = threading.Lock()
+        self.hits: int = 0
+        self.disk_hits: int = 0
+        self.misses: int = 0
+        self.render_seconds: float = 0.0
+        self.pending: dict[str, PendingRender] = {}
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._load_disk_entries()
+
+    def _load_disk_entries(self) -> None:
+        # file modification times carry the use order across restarts, get() touches the files it reads
+        files = []
+        with os.scandir(self.cache_dir) as entries:
+            for entry in entries:
+                if entry.name.endswith('.png'):
+                    try:
+                        files.append((entry.stat().st_mtime, entry.name[:-len('.png')]))
+                    except OSError:
+                        pass
+        for _, key in sorted(files):
+            self.disk_entries[key] = None
+        self._prune_disk()
+
+    def _prune_disk(self) -> None:
+        """Delete the least recently used files beyond max_disk_entries. Called with the lock held."""
+        while len(self.disk_entries) > self.max_disk_entries:
+            key, _ = self.disk_entries.popitem(last=False)
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + '.png')
+
+    def _remember(self, key: str, image: bytes) -> None:
+        self.entries[key] = image
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get(self, key: str, count: bool = True) -> bytes | None:
+        """Cached image for key, from memory or disk. Lookups with count=False are left out of the hit counts."""
+        with self.lock:
+            image = self.entries.get(key)
+            if image is not None:
+                self.entries.move_to_end(key)
+                self.hits += count
+                return image
+        if self.cache_dir is not None:
+            try:
+                with open(self._path(key), 'rb') as f:
+                    image = f.read()
+            except OSError:
+                image = None
+            if image:
+                try:
+                    os.utime(self._path(key))
+                except OSError:
+                    pass
+                with self.lock:
+                    self._remember(key, image)
+                    self.disk_entries[key] = None
+                    self.disk_entries.move_to_end(key)
+                    self.hits += count
+                    self.disk_hits += count
+                return image
+        return None
+
+    def put(self, key: str, image: bytes) -> None:
+        with self.lock:
+            self._remember(key, image)
+        if self.cache_dir is not None:
+            temp_path = self._path(key) + '.tmp'
+            try:
+                with open(temp_path, 'wb') as f:
+                    f.write(image)
+                os.replace(temp_path, self._path(key))
+            except OSError:
+                return
+            with self.lock:
+                self.disk_entries[key] = None
+                self.disk_entries.move_to_end(key)
+                self._prune_disk()
+
+    def get_or_render(self, key: str, render: Callable[[], bytes | None]) -> bytes | None:
+        """Return the cached image for key, otherwise render it and cache the result if rendering succeeded"""
+        image = self.get(key)
+        if image is not None:
+            return image
+        start = time.perf_counter()
+        image = render()
+        with self.lock:
+            self.misses += 1
+            self.render_seconds += time.perf_counter() - start
+        if image is not None:
+            self.put(key, image)
+        return image
+
+    async def _render_async(self, key: str, render: Callable[[], Awaitable[bytes | None]]) -> bytes | None:
+        start = time.perf_counter()
+        try:
+            image = await render()
+        finally:
+            with self.lock:
+                self.misses += 1
+                self.render_seconds += time.perf_counter() - start
+        if image is not None:
+            self.put(key, image)
+        return image
+
+    async def get_or_render_async(self, key: str, render: Callable[[], Awaitable[bytes | None]]) -> bytes | None:
+        """Async get_or_render that coalesces concurrent renders of the same key.
+
+        The render is cancelled once every caller waiting on it has been cancelled.
+        """
+        image = self.get(key)
+        if image is not None:
+            return image
+        pending = self.pending.get(key)
+        if pending is None or pending.abandoned:
+            pending = PendingRender(asyncio.ensure_future(self._render_async(key, render)))
+            self.pending[key] = pending
+            pending.task.add_done_callback(
+                lambda _, pending=pending: self.pending.pop(key, None) if self.pending.get(key) is pending else None)
+        pending.waiters += 1
+        try:
+            return await asyncio.shield(pending.task)
+        finally:
+            pending.waiters -= 1
+            if pending.waiters == 0 and not pending.task.done():
+                pending.abandoned = True
+                pending.task.cancel()
+
+    def stats(self) -> dict[str, float]:
+        """Hit/miss counters and the render time the hits are estimated to have saved"""
+        with self.lock:
+            average_render = self.render_seconds / self.misses if self.misses else 0.0
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'entries': len(self.entries),
+                'disk_entries': len(self.disk_entries),
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'render_seconds': self.render_seconds,
+                'saved_seconds': self.hits * average_render,
+            }
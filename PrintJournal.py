@@ -0,0 +1,209 @@
+"""
+Append-only journal of printed labels.
+
+Each printed label is one tab separated line: timestamp, unit number, output
+mode, printer and a SHA-256 of the label's ZPL (one copy, as label_zpl
+builds it, however it was sent). Lines are only ever appended,
+in time order. A sidecar index ({journal}.idx) holds the byte offset of the
+first line of every day. With it, startup reads only the recent window
+(today or the current shift, whichever is longer) into a dict of unit
+number -> last printed time, and an export seeks straight to the first day
+it needs. Labels waiting for a printer are held in memory until their job
+finishes, so they are warned about as reprints too.
+"""
+import csv
+import hashlib
+import io
+import threading
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Iterable, Iterator
+
+SHIFT_HOURS = 12.0
+EXPORT_CHUNK_SIZE = 64 * 1024  # characters of CSV per chunk of an export
+
+
+@dataclass(frozen=True, slots=True)
+class JournalEntry:
+    timestamp: datetime
+    din: str
+    mode: int
+    printer: str
+    zpl_hash: str
+
+    def to_line(self) -> bytes:
+        fields = (self.timestamp.isoformat(timespec='seconds'), self.din, str(self.mode), self.printer, self.zpl_hash)
+        return ('\t'.join(field.replace('\t', ' ').replace('\n', ' ') for field in fields) + '\n').encode('utf-8')
+
+    @classmethod
+    def from_line(cls, line: bytes) -> 'JournalEntry | None':
+        fields = line.decode('utf-8', errors='replace').rstrip('\n').split('\t')
+        if len(fields) != 5:
+            return None  # e.g. a line cut short by a crash
+        try:
+            return cls(datetime.fromisoformat(fields[0]), fields[1], int(fields[2]), fields[3], fields[4])
+        except ValueError:
+            return None
+
+
+def zpl_hash(zpl: str) -> str:
+    return hashlib.sha256(zpl.encode('utf-8')).hexdigest()
+
+
+def journal_key(barcode: str, mode: int) -> str | None:
+    """Unit number a label is journalled and checked for reprints under, None for free text"""
+    return barcode[:13] if mode in (1, 2) else None
+
+
+class PrintJournal:
+    def __init__(self, path: str, shift_hours: float = SHIFT_HOURS):
+        self.path = path
+        self.index_path = path + '.idx'
+        self.shift_hours = shift_hours
+        self.lock = threading.Lock()
+        self.day_offsets: dict[str, int] = {}  # first line of each day, in journal order
+        self.last_printed: dict[str, datetime] = {}  # unit numbers printed in the recent window
+        self.queued: dict[str, list[datetime]] = {}  # unit numbers sent to a printer, by when, not printed yet
+        self._load()
+
+    def window_start(self, now: datetime | None = None) -> datetime:
+        """Start of today or of the current shift, whichever is earlier"""
+        now = now or datetime.now()
+        return min(now.replace(hour=0, minute=0, second=0, microsecond=0), now - timedelta(hours=self.shift_hours))
+
+    def _load(self) -> None:
+        try:
+            with open(self.index_path, encoding='utf-8') as f:
+                for line in f:
+                    day, _, offset = line.strip().partition(' ')
+                    if offset.isdigit():
+                        self.day_offsets[day] = int(offset)
+        except OSError:
+            pass
+        self._end_last_line()
+        window_start = self.window_start()
+        window_day = window_start.date().isoformat()
+        # read from the first day in the window, or from the last indexed day if the journal has not been
+        # used since. Days missing from the index (e.g. after a crash) are added on the way.
+        start = next((offset for day, offset in self.day_offsets.items() if day >= window_day),
+                     max(self.day_offsets.values(), default=0))
+        missing_days = []
+        for offset, entry in self._read_from(start):
+            day = entry.timestamp.date().isoformat()
+            if day not in self.day_offsets:
+                self.day_offsets[day] = offset
+                missing_days.append(day)
+            if entry.timestamp >= window_start:
+                self.last_printed[entry.din] = entry.timestamp
+        if missing_days:
+            with open(self.index_path, 'a', encoding='utf-8') as f:
+                f.writelines('{} {}\n'.format(day, self.day_offsets[day]) for day in missing_days)
+
+    def _end_last_line(self) -> None:
+        """Terminate a line left unfinished by a crash, so the next entry starts on a line of its own"""
+        try:
+            with open(self.path, 'rb+') as f:
+                if f.seek(0, 2) > 0:
+                    f.seek(-1, 2)
+                    if f.read(1) != b'\n':
+                        f.write(b'\n')
+        except OSError:
+            pass
+
+    def _read_from(self, offset: int) -> Iterator[tuple[int, JournalEntry]]:
+        """Stream (offset, entry) from offset to the end of the journal"""
+        try:
+            f = open(self.path, 'rb')
+        except OSError:
+            return
+        with f:
+            f.seek(offset)
+            while line := f.readline():
+                entry = JournalEntry.from_line(line)
+                if entry is not None:
+                    yield offset, entry
+                offset += len(line)
+
+    def record(self, entries: Iterable[JournalEntry]) -> None:
+        with self.lock:
+            with open(self.path, 'ab') as journal:
+                new_days = []
+                for entry in entries:
+                    day = entry.timestamp.date().isoformat()
+                    if day not in self.day_offsets:
+                        self.day_offsets[day] = journal.tell()
+                        new_days.append(day)
+                    journal.write(entry.to_line())
+                    self.last_printed[entry.din] = entry.timestamp
+            if new_days:
+                with open(self.index_path, 'a', encoding='utf-8') as index:
+                    index.writelines('{} {}\n'.format(day, self.day_offsets[day]) for day in new_days)
+                self._forget_before(self.window_start())
+
+    def record_printed(self, labels: Iterable[tuple[str, str]], mode: int, printer: str) -> None:
+        """Journal (barcode, ZPL) pairs that were printed just now. Free text labels are not journalled."""
+        now = datetime.now().replace(microsecond=0)
+        self.record(JournalEntry(now, key, mode, printer, zpl_hash(zpl))
+                    for key, zpl in ((journal_key(barcode, mode), zpl) for barcode, zpl in labels)
+                    if key is not None)
+
+    def record_queued(self, barcodes: Iterable[str], mode: int) -> None:
+        """Note labels handed to a printer, so a second scan is warned about before the first has printed.
+
+        Every call is matched by forget_queued once the job has printed or failed."""
+        now = datetime.now().replace(microsecond=0)
+        with self.lock:
+            for key in filter(None, (journal_key(barcode, mode) for barcode in barcodes)):
+                self.queued.setdefault(key, []).append(now)
+
+    def forget_queued(self, barcodes: Iterable[str], mode: int) -> None:
+        with self.lock:
+            for key in filter(None, (journal_key(barcode, mode) for barcode in barcodes)):
+                times = self.queued.get(key)
+                if times:
+                    times.pop(0)
+                    if not times:
+                        del self.queued[key]
+
+    def _forget_before(self, start: datetime) -> None:
+        # called on the first print of a new day, so the dict only holds the recent window
+        self.last_printed = {din: timestamp for din, timestamp in self.last_printed.items() if timestamp >= start}
+
+    def printed_recently(self, barcode: str, mode: int) -> datetime | None:
+        """When the unit number was last printed today or this shift, or queued to print, None if it was not"""
+        key = journal_key(barcode, mode)
+        if key is None:
+            return None
+        queued = self.queued.get(key)
+        if queued:
+            return queued[-1]
+        timestamp = self.last_printed.get(key)
+        if timestamp is not None and timestamp >= self.window_start():
+            return timestamp
+        return None
+
+    def entries(self, start: datetime, end: datetime) -> Iterator[JournalEntry]:
+        """Stream the entries printed from start up to (not including) end"""
+        start_day = start.date().isoformat()
+        offset = next((offset for day, offset in self.day_offsets.items() if day >= start_day), None)
+        if offset is None:
+            return
+        for _, entry in self._read_from(offset):
+            if entry.timestamp >= end:
+                break
+            if entry.timestamp >= start:
+                yield entry
+
+    def export_csv(self, start: datetime, end: datetime) -> Iterator[str]:
+        """CSV lines of the entries from start up to end, generated as the journal is read"""
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(['timestamp', 'unit_number', 'mode', 'printer', 'zpl_sha256'])
+        for entry in self.entries(start, end):
+            writer.writerow([entry.timestamp.isoformat(timespec='seconds'), entry.din, entry.mode, entry.printer,
+                             entry.zpl_hash])
+            if buffer.tell() >= EXPORT_CHUNK_SIZE:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
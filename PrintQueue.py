@@ -0,0 +1,371 @@
+"""
+Background print worker and printer pool.
+
+Print jobs are put on a bounded queue and sent by a dedicated thread for each
+printer, so a slow or offline printer never blocks the UI or other printers. Printer transports are kept
+open between jobs and transient failures are retried on a fresh transport,
+unless part of the job had already been sent.
+Stored formats a job recalls are downloaded first if the printer does not
+hold them yet, decided as the job is written.
+
+PrinterPool spreads jobs over several printers, each with its own worker, and
+moves jobs off a printer that fails.
+"""
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Callable
+
+from Metrics import registry, stage_seconds
+from StoredFormats import StoredFormatTracker
+from Transports import PartialWriteError, PrinterTransport
+
+queue_depth = registry.gauge('bcprinter_print_queue_depth', 'Jobs waiting for each print worker')
+print_jobs = registry.counter('bcprinter_print_jobs_total', 'Print jobs finished by the worker, by result')
+pool_failovers = registry.counter('bcprinter_pool_failovers_total', 'Pool jobs moved off a failed printer')
+
+# assumed speed of a pool printer until its first job has been timed
+DEFAULT_SECONDS_PER_LABEL = 1.0
+
+
+class PrintJob:
+    """formats maps the name of each stored format zpl_code recalls to the ZPL that downloads it"""
+    def __init__(self, zpl_code: str, printer_name: str, debug: bool = False, formats: dict[str, str] | None = None):
+        self.zpl_code = zpl_code
+        self.printer_name = printer_name
+        self.debug = debug
+        self.formats = formats or {}
+        self.future: Future = Future()
+        self.queued_at = time.perf_counter()
+        self.started_at: float | None = None
+        self.finished_at: float | None = None
+
+
+class PrintWorker:
+    def __init__(self, open_transport: Callable[[str, bool], PrinterTransport], maxsize: int = 32,
+                 retries: int = 2, retry_delay: float = 0.5, name: str = 'print worker',
+                 stored_formats: StoredFormatTracker | None = None):
+        self.open_transport = open_transport
+        self.name = name
+        self.stored_formats = stored_formats
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.jobs: queue.Queue[PrintJob | None] = queue.Queue(maxsize)
+        self.transports: dict[tuple[str, bool], PrinterTransport] = {}
+        self.thread: threading.Thread | None = None
+
+    @property
+    def queue_depth(self) -> int:
+        return self.jobs.qsize()
+
+    def start(self) -> None:
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self.thread.start()
+
+    def stop(self) -> None:
+        if self.thread is not None:
+            self.jobs.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def submit(self, zpl_code: str, printer_name: str, debug: bool = False,
+               formats: dict[str, str] | None = None) -> Future:
+        """Queue a job and return a future that resolves to the printer name when it has been sent.
+
+        Raises queue.Full when busy."""
+        return self.submit_job(PrintJob(zpl_code, printer_name, debug, formats))
+
+    def submit_job(self, job: PrintJob) -> Future:
+        self.start()
+        self.jobs.put_nowait(job)
+        queue_depth.set(self.jobs.qsize(), worker=self.name)
+        return job.future
+
+    def drain(self) -> list[PrintJob]:
+        """Take the jobs still waiting in the queue, e.g. to send them to another printer"""
+        jobs = []
+        stopping = False
+        while True:
+            try:
+                job = self.jobs.get_nowait()
+            except queue.Empty:
+                break
+            if job is None:
+                stopping = True
+            else:
+                jobs.append(job)
+        if stopping:
+            self.jobs.put(None)
+        queue_depth.set(self.jobs.qsize(), worker=self.name)
+        return jobs
+
+    def _close(self, key: tuple[str, bool]) -> None:
+        transport = self.transports.pop(key, None)
+        if transport is not None:
+            try:
+                transport.close()
+            except Exception:
+                pass
+
+    def _write(self, transport: PrinterTransport, job: PrintJob) -> None:
+        if not job.formats or self.stored_formats is None:
+            transport.write(job.zpl_code)
+            return
+        # workers sending to the same printer take turns, so a recall cannot overtake the download it relies on
+        with self.stored_formats.printer_lock(job.printer_name):
+            downloads = ''.join(download for name, download in job.formats.items()
+                                if self.stored_formats.claim(job.printer_name, name))
+            transport.write(downloads + job.zpl_code)
+
+    def _send(self, job: PrintJob) -> None:
+        key = (job.printer_name, job.debug)
+        for attempt in range(self.retries + 1):
+            try:
+                transport = self.transports.get(key)
+                if transport is None:
+                    transport = self.open_transport(job.printer_name, job.debug)
+                    self.transports[key] = transport
+                self._write(transport, job)
+                return
+            except Exception as e:
+                # drop the transport so the next attempt reopens the printer
+                self._close(key)
+                if self.stored_formats is not None:
+                    # the printer may have been reset or replaced, download the formats again
+                    self.stored_formats.forget(job.printer_name)
+                # after a partial write, resending the job would print its first labels twice
+                if attempt == self.retries or isinstance(e, PartialWriteError):
+                    raise
+                time.sleep(self.retry_delay * (attempt + 1))
+
+    def _run(self) -> None:
+        while True:
+            job = self.jobs.get()
+            queue_depth.set(self.jobs.qsize(), worker=self.name)
+            if job is None:
+                break
+            if job.future.set_running_or_notify_cancel():
+                job.started_at = time.perf_counter()
+                stage_seconds.observe(job.started_at - job.queued_at, stage='print_queue_wait')
+                try:
+                    self._send(job)
+                    job.finished_at = time.perf_counter()
+                    print_jobs.inc(result='ok')
+                    job.future.set_result(job.printer_name)
+                except Exception as e:
+                    job.finished_at = time.perf_counter()
+                    print_jobs.inc(result='error')
+                    job.future.set_exception(e)
+        for key in list(self.transports):
+            self._close(key)
+
+
+class PrintWorkers:
+    """A PrintWorker for each printer, started on its first job, so a slow or unreachable printer only holds up
+    the jobs sent to it"""
+    def __init__(self, open_transport: Callable[[str, bool], PrinterTransport], maxsize: int = 32,
+                 stored_formats: StoredFormatTracker | None = None):
+        self.open_transport = open_transport
+        self.maxsize = maxsize
+        self.stored_formats = stored_formats
+        self.workers: dict[str, PrintWorker] = {}
+        self.lock = threading.Lock()
+
+    def worker(self, printer_name: str) -> PrintWorker:
+        with self.lock:
+            worker = self.workers.get(printer_name)
+            if worker is None:
+                worker = self.workers[printer_name] = PrintWorker(
+                    self.open_transport, self.maxsize, name=f'print worker {printer_name}',
+                    stored_formats=self.stored_formats)
+        return worker
+
+    @property
+    def queue_depth(self) -> int:
+        with self.lock:
+            return sum(worker.queue_depth for worker in self.workers.values())
+
+    def submit(self, zpl_code: str, printer_name: str, debug: bool = False,
+               formats: dict[str, str] | None = None) -> Future:
+        """Queue a job on the printer's worker, see PrintWorker.submit. Raises queue.Full when that printer is busy."""
+        return self.worker(printer_name).submit(zpl_code, printer_name, debug, formats)
+
+    def stop(self) -> None:
+        with self.lock:
+            workers = list(self.workers.values())
+        for worker in workers:
+            worker.stop()
+
+
+class PrinterOffline(Exception):
+    pass
+
+
+class PoolJob:
+    def __init__(self, zpl_code: str, labels: int, printers: list[str], debug: bool = False,
+                 formats: dict[str, str] | None = None):
+        self.zpl_code = zpl_code
+        self.formats = formats
+        self.labels = labels
+        self.printers = printers
+        self.debug = debug
+        self.tried: list[str] = []
+        self.error: Exception | None = None
+        self.future: Future = Future()
+
+
+class PoolPrinter:
+    def __init__(self, worker: PrintWorker):
+        self.worker = worker
+        self.queued_jobs: int = 0
+        self.queued_labels: int = 0
+        self.seconds_per_label: float | None = None  # smoothed over the jobs sent so far
+        self.printed_labels: int = 0
+        self.failures: int = 0
+        self.offline_until: float = 0.0
+
+    @property
+    def labels_per_minute(self) -> float | None:
+        return 60 / self.seconds_per_label if self.seconds_per_label else None
+
+
+class PrinterPool:
+    """Printers that share the work of a print run, each with its own PrintWorker.
+
+    Jobs wait in the pool and each printer is given at most max_queued at a time, so a faster printer comes
+    back for work sooner and takes a bigger share. When several printers have room, the job goes to the one
+    expected to finish it first: the labels queued on it plus the job's, times its observed seconds per label.
+    Time is measured from the worker starting a job until the last byte is written, which for large jobs is
+    paced by the printer once its receive buffer is full. A printer that fails a job is skipped for
+    offline_seconds and the jobs queued on it are moved to the others. A job the printer failed part way through
+    is not moved, as some of its labels may have printed.
+    """
+    def __init__(self, open_transport: Callable[[str, bool], PrinterTransport], max_queued: int = 2,
+                 offline_seconds: float = 30.0, smoothing: float = 0.3,
+                 stored_formats: StoredFormatTracker | None = None):
+        self.open_transport = open_transport
+        self.max_queued = max_queued
+        self.offline_seconds = offline_seconds
+        self.smoothing = smoothing
+        self.stored_formats = stored_formats
+        self.printers: dict[str, PoolPrinter] = {}
+        self.waiting: deque[PoolJob] = deque()
+        self.lock = threading.Lock()
+
+    def _printer(self, printer_name: str) -> PoolPrinter:
+        printer = self.printers.get(printer_name)
+        if printer is None:
+            printer = self.printers[printer_name] = PoolPrinter(
+                PrintWorker(self.open_transport, retries=1, name=f'pool worker {printer_name}',
+                            stored_formats=self.stored_formats))
+        return printer
+
+    def _choose(self, job: PoolJob) -> str | None:
+        """Printer to send job to now, None if it has to wait. Fails the job if no printer is left to try."""
+        now = time.monotonic()
+        untried = [name for name in job.printers if name not in job.tried]
+        if not untried:
+            job.future.set_exception(job.error or PrinterOffline('No printer in the pool is available'))
+            return None
+        # an offline printer is still tried if nothing else is left, it may have come back
+        candidates = [name for name in untried if self._printer(name).offline_until <= now] or untried
+        candidates = [name for name in candidates if self._printer(name).queued_jobs < self.max_queued]
+        if not candidates:
+            return None
+        timed = [printer.seconds_per_label for printer in self.printers.values() if printer.seconds_per_label]
+        default = sum(timed) / len(timed) if timed else DEFAULT_SECONDS_PER_LABEL
+
+        def expected_finish(name: str) -> float:
+            printer = self._printer(name)
+            return (printer.queued_labels + job.labels) * (printer.seconds_per_label or default)
+        return min(candidates, key=expected_finish)
+
+    def submit(self, zpl_code: str, labels: int, printers: list[str], debug: bool = False,
+               formats: dict[str, str] | None = None) -> Future:
+        """Queue a job of labels on one of printers. The future resolves to the name of the printer used."""
+        job = PoolJob(zpl_code, labels, printers, debug, formats)
+        with self.lock:
+            self.waiting.append(job)
+        self._pump()
+        return job.future
+
+    def _pump(self) -> None:
+        """Send waiting jobs, in order, to printers that have room for them"""
+        while True:
+            with self.lock:
+                for job in self.waiting:
+                    printer_name = self._choose(job)
+                    if printer_name is not None or job.future.done():
+                        break
+                else:
+                    return
+                self.waiting.remove(job)
+                if job.future.done():
+                    continue
+                job.tried.append(printer_name)
+                printer = self._printer(printer_name)
+                printer.queued_jobs += 1
+                printer.queued_labels += job.labels
+            try:
+                print_job = PrintJob(job.zpl_code, printer_name, job.debug, job.formats)
+                printer.worker.submit_job(print_job)
+            except Exception as e:
+                with self.lock:
+                    printer.queued_jobs -= 1
+                    printer.queued_labels -= job.labels
+                    if isinstance(e, queue.Full):
+                        job.error = e
+                        self.waiting.appendleft(job)
+                        continue
+                job.future.set_exception(e)
+                continue
+            print_job.future.add_done_callback(lambda _, job=job, print_job=print_job: self._finished(job, print_job))
+
+    def _finished(self, job: PoolJob, print_job: PrintJob) -> None:
+        printer_name = print_job.printer_name
+        error = print_job.future.exception()
+        with self.lock:
+            printer = self.printers[printer_name]
+            printer.queued_jobs -= 1
+            printer.queued_labels -= job.labels
+            if error is None:
+                seconds_per_label = (print_job.finished_at - print_job.started_at) / max(job.labels, 1)
+                printer.seconds_per_label = seconds_per_label if printer.seconds_per_label is None else (
+                    self.smoothing * seconds_per_label + (1 - self.smoothing) * printer.seconds_per_label)
+                printer.printed_labels += job.labels
+            else:
+                if not isinstance(error, PrinterOffline):
+                    printer.failures += 1
+                    printer.offline_until = time.monotonic() + self.offline_seconds
+                if not isinstance(error, PartialWriteError):
+                    pool_failovers.inc(printer=printer_name)
+                    job.error = error
+                    # retried ahead of jobs that have not been sent yet
+                    self.waiting.appendleft(job)
+        if error is None:
+            job.future.set_result(printer_name)
+        else:
+            if isinstance(error, PartialWriteError):
+                # some of the job's labels may have printed, sending it to another printer could print them twice
+                job.future.set_exception(error)
+            if not isinstance(error, PrinterOffline):
+                # the jobs queued behind this one would fail the same way, move them now
+                for queued in printer.worker.drain():
+                    queued.future.set_exception(PrinterOffline(printer_name))
+        self._pump()
+
+    def stats(self) -> dict[str, dict[str, float | None]]:
+        with self.lock:
+            return {name: {'queued_labels': printer.queued_labels,
+                           'printed_labels': printer.printed_labels,
+                           'failures': printer.failures,
+                           'labels_per_minute': printer.labels_per_minute,
+                           'offline': printer.offline_until > time.monotonic()}
+                    for name, printer in self.printers.items()}
+
+    def stop(self) -> None:
+        for printer in list(self.printers.values()):
+            printer.worker.stop()
@@ -0,0 +1,36 @@
+"""
+Telling barcode scanner input apart from typing.
+
+A keyboard wedge scanner types a whole unit number in a few milliseconds,
+while people leave 100 ms or more between keys. The input is processed once
+it has been still for key_interval, so a scan is handled as one value, and
+the burst that produced it is classed as a scan if enough keys arrived at
+scanner speed.
+"""
+import time
+
+# scanners send a character every few milliseconds, typing is at least ~60 ms per key
+SCAN_KEY_INTERVAL = 0.03  # seconds
+# shorter bursts are more likely fast typing or key repeat than a scanned unit number
+SCAN_MIN_KEYS = 8
+
+
+class ScanBurstDetector:
+    def __init__(self, key_interval: float = SCAN_KEY_INTERVAL, min_keys: int = SCAN_MIN_KEYS):
+        self.key_interval = key_interval
+        self.min_keys = min_keys
+        self.last_change: float | None = None
+        self.burst_keys: int = 0
+
+    def keystroke(self, now: float | None = None) -> None:
+        """Record an input change, starting a new burst if the input had been still for key_interval"""
+        now = time.perf_counter() if now is None else now
+        if self.last_change is None or now - self.last_change > self.key_interval:
+            self.burst_keys = 0
+        self.burst_keys += 1
+        self.last_change = now
+
+    @property
+    def is_scan(self) -> bool:
+        """True if the latest burst came in at scanner speed"""
+        return self.burst_keys >= self.min_keys
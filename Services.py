@@ -0,0 +1,140 @@
+"""
+Services shared by every connected client.
+
+Each browser tab or scanning station gets its own Session in BCPrinter.py.
+The work that is the same for all of them (rendering previews with Labelary,
+listing printers) lives here, so the stations share one connection pool and
+one printer list instead of each holding their own.
+"""
+import asyncio
+import threading
+import time
+
+from Metrics import registry, timed
+from Transports import get_win32print
+
+LABELARY_URL = 'http://api.labelary.com/v1/printers/{}dpmm/labels/{}x{}/0/'
+
+# enumerating printers on a domain can take seconds, so the list is reused for this long
+PRINTER_LIST_TTL = 300.0  # seconds
+
+labelary_responses = registry.counter('bcprinter_labelary_responses_total', 'Labelary API responses by HTTP status')
+
+
+class PreviewError(Exception):
+    pass
+
+
+class LabelaryService:
+    """Labelary API client whose keep-alive connections are shared by every session"""
+    def __init__(self, url: str = LABELARY_URL, max_connections: int = 4):
+        self.url = url
+        self.max_connections = max_connections
+        self.client = None
+
+    def get_client(self):
+        # all sessions run on NiceGUI's event loop, so creating the client needs no lock
+        if self.client is None:
+            # imported on first use, it is only needed once a preview goes to Labelary
+            import httpx
+            self.client = httpx.AsyncClient(timeout=5, limits=httpx.Limits(
+                max_connections=self.max_connections, max_keepalive_connections=self.max_connections))
+        return self.client
+
+    async def close(self) -> None:
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def check_connection(self) -> bool:
+        """Check connection to Labelary API"""
+        import httpx
+        try:
+            await self.get_client().post(self.url.format(8, 4, 2), content='^XA^FO0,0^A0,30^FDTest^FS^XZ')
+            return True
+        except httpx.HTTPError:
+            return False
+
+    @timed('labelary')
+    async def render_png(self, zpl: str, dpmm: str, width: str, height: str) -> bytes | None:
+        """Render ZPL to PNG via the Labelary API"""
+        import httpx
+        try:
+            response = await self.get_client().post(self.url.format(dpmm, width, height), content=zpl)
+        except httpx.HTTPError:
+            labelary_responses.inc(status='connection error')
+            return None
+        labelary_responses.inc(status=str(response.status_code))
+        if response.status_code == 200:
+            return response.content
+        elif response.status_code == 429:
+            raise PreviewError('Error: Too many requests to Labelary API. Please wait and try again later.')
+        else:
+            raise PreviewError('Error: ' + response.text)
+
+
+class PrinterDirectory:
+    """Printers known to this host: raw TCP printers from the command line plus the Windows print queues
+
+    The Windows printers are enumerated in a worker thread and cached for ttl seconds, so a page load never
+    waits for the spooler."""
+    def __init__(self, network_printers: list[str] | None = None, ttl: float = PRINTER_LIST_TTL):
+        self.network_printers: list[str] = list(network_printers or [])
+        self.ttl = ttl
+        # serialises refreshes started from the startup thread and from sessions
+        self.lock = threading.Lock()
+        self.windows_printers: list[str] = []
+        self.windows_default: str | None = None
+        self.refreshed_at: float | None = None
+        self.refreshing: asyncio.Future | None = None
+
+    @property
+    def stale(self) -> bool:
+        return self.refreshed_at is None or time.monotonic() - self.refreshed_at > self.ttl
+
+    def refresh(self) -> None:
+        """Enumerate the Windows printers, blocking until the spooler answers"""
+        requested_at = time.monotonic()
+        win32print = get_win32print()
+        printers = []
+        default = None
+        with self.lock:
+            if self.refreshed_at is not None and self.refreshed_at >= requested_at:
+                return  # another thread refreshed the list while this one waited for the lock
+            if win32print is not None:
+                try:
+                    default = win32print.GetDefaultPrinter()
+                except Exception:
+                    pass
+                # When Name is NULL, setting Flags to PRINTER_ENUM_LOCAL | PRINTER_ENUM_CONNECTIONS enumerates
+                # printers that are installed on the local machine. These printers include those that are
+                # physically attached to the local machine as well as remote printers to which it has a network
+                # connection.
+                try:
+                    flags = win32print.PRINTER_ENUM_LOCAL | win32print.PRINTER_ENUM_CONNECTIONS
+                    printers = [printer[2] for printer in win32print.EnumPrinters(flags)]
+                except Exception:
+                    pass
+            self.windows_printers = printers
+            self.windows_default = default
+            self.refreshed_at = time.monotonic()
+
+    async def refresh_if_stale(self) -> bool:
+        """Refresh in a worker thread if the cached list has expired. Returns True if it was refreshed.
+
+        Sessions loading at the same time share one refresh."""
+        if not self.stale:
+            return False
+        if self.refreshing is None or self.refreshing.done():
+            self.refreshing = asyncio.ensure_future(asyncio.to_thread(self.refresh))
+        await asyncio.shield(self.refreshing)
+        return True
+
+    def default_printer(self) -> str | None:
+        if self.windows_default is not None:
+            return self.windows_default
+        return self.network_printers[0] if self.network_printers else None
+
+    def printers(self) -> list[str]:
+        """Get list of available printers, as of the last refresh"""
+        return self.network_printers + self.windows_printers
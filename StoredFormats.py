@@ -0,0 +1,61 @@
+"""
+Printer-resident stored formats (^DF/^XF).
+
+The label layout is downloaded to a printer once as a stored format, after
+which each label only sends a ^XF recall with the field data (^FN). Format
+names are derived from a hash of the layout, so changing the output mode or
+padding produces a new format version that is downloaded again.
+"""
+import hashlib
+import threading
+
+# E: is flash memory, so formats survive the printer being power cycled
+FORMAT_DRIVE = 'E'
+
+
+def stored_format_name(layout: str) -> str:
+    """8 character object name identifying this version of the layout"""
+    return 'BCP' + hashlib.sha1(layout.encode('utf-8')).hexdigest()[:5].upper()
+
+
+def stored_format_zpl(name: str, layout: str) -> str:
+    return "^XA^DF{}:{}.ZPL^FS{}^XZ".format(FORMAT_DRIVE, name, layout)
+
+
+def recall_format_zpl(name: str, field_data: list[str], copies: int = 1) -> str:
+    zpl = "^XA^XF{}:{}.ZPL^FS".format(FORMAT_DRIVE, name)
+    for number, data in enumerate(field_data, start=1):
+        zpl += "^FN{}^FD{}^FS".format(number, data)
+    if copies > 1:
+        zpl += "^PQ{}".format(copies)
+    return zpl + "^XZ"
+
+
+class StoredFormatTracker:
+    """Remembers which format versions each printer already holds
+
+    The print workers claim a format as they write the job that needs it, so the record matches what was
+    actually sent."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.formats: dict[str, set[str]] = {}
+        self.printer_locks: dict[str, threading.Lock] = {}
+
+    def claim(self, printer_name: str, name: str) -> bool:
+        """Record that printer_name holds format name. Returns True if it has to be downloaded first."""
+        with self.lock:
+            formats = self.formats.setdefault(printer_name, set())
+            if name in formats:
+                return False
+            formats.add(name)
+            return True
+
+    def printer_lock(self, printer_name: str) -> threading.Lock:
+        """Held while a job that uses stored formats is written to printer_name"""
+        with self.lock:
+            return self.printer_locks.setdefault(printer_name, threading.Lock())
+
+    def forget(self, printer_name: str) -> None:
+        """Download formats again after a failed job, the printer may have been reset or replaced"""
+        with self.lock:
+            self.formats.pop(printer_name, None)
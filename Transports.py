@@ -0,0 +1,185 @@
+"""
+Printer transports used by the print worker.
+
+Every transport has write(zpl_code) and close(). Printer names starting with
+tcp:// are Zebra printers reached directly on their raw port (9100 by default),
+other names are Windows print queues written to through the spooler.
+"""
+import select
+import socket
+from functools import lru_cache
+
+from Metrics import timed
+
+RAW_PREFIX = 'tcp://'
+RAW_PORT = 9100
+
+
+@lru_cache(maxsize=None)
+def get_win32print():
+    """pywin32's win32print, imported on first use as it is slow to load. None if it is not installed."""
+    try:
+        import win32print
+    except ImportError:  # not on Windows, only raw TCP printers are available
+        return None
+    return win32print
+
+
+class PartialWriteError(OSError):
+    """The connection failed after part of the job was sent, so some of its labels may have printed.
+
+    Resending the job could print those labels twice, so it is not retried."""
+    def __init__(self, printer_name: str, sent: int, total: int):
+        super().__init__("connection to {} was lost after {} of {} bytes, the labels may be partially printed"
+                         .format(printer_name, sent, total))
+        self.sent = sent
+        self.total = total
+
+
+class PrinterTransport:
+    def write(self, zpl_code: str) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+@timed('zebra_print_zpl')
+def zebra_print_zpl(zpl_code: str, printer_name: str, hPrinter=None):
+    """Send ZPL commands to Zebra printer using Win32 Print Spooler API
+
+    If an open printer handle is given it is reused and left open."""
+    win32print = get_win32print()
+    try:
+        # Open a handle to the printer
+        owns_handle = hPrinter is None
+        if owns_handle:
+            hPrinter = win32print.OpenPrinter(printer_name)
+        try:
+            # Start a print job
+            win32print.StartDocPrinter(hPrinter, 1, ("ZPL Print Job", None, "RAW"))
+            try:
+                # Start a page and write the ZPL code
+                # These steps would typically be repeated for multiple pages
+                win32print.StartPagePrinter(hPrinter)
+                win32print.WritePrinter(hPrinter, zpl_code.encode('utf-8'))
+                win32print.EndPagePrinter(hPrinter)
+            finally:
+                win32print.EndDocPrinter(hPrinter)
+        finally:
+            if owns_handle:
+                win32print.ClosePrinter(hPrinter)
+    except Exception as e:
+        raise
+
+
+class Win32SpoolerTransport(PrinterTransport):
+    """Printer handle kept open between jobs, each job is a RAW spooler document"""
+    def __init__(self, printer_name: str):
+        if get_win32print() is None:
+            raise OSError("The Windows print spooler is not available on this system")
+        self.printer_name = printer_name
+        self.hPrinter = get_win32print().OpenPrinter(printer_name)
+
+    def write(self, zpl_code: str) -> None:
+        zebra_print_zpl(zpl_code, self.printer_name, self.hPrinter)
+
+    def close(self) -> None:
+        get_win32print().ClosePrinter(self.hPrinter)
+
+
+class RawSocketTransport(PrinterTransport):
+    """Persistent TCP connection streaming ZPL straight to a printer's raw port"""
+    def __init__(self, host: str, port: int = RAW_PORT, timeout: float = 5.0):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.sock: socket.socket | None = None
+
+    def _connect(self) -> socket.socket:
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    def _is_stale(self) -> bool:
+        """True if the printer has closed the idle connection (or sent something we do not expect)"""
+        readable, _, _ = select.select([self.sock], [], [], 0)
+        if not readable:
+            return False
+        try:
+            return self.sock.recv(1, socket.MSG_PEEK) == b''
+        except OSError:
+            return True
+
+    @timed('raw_socket_write')
+    def write(self, zpl_code: str) -> None:
+        data = zpl_code.encode('utf-8')
+        if self.sock is not None and self._is_stale():
+            # nothing of this job has been sent yet, so it is safe to reconnect and send it
+            self.close()
+        if self.sock is None:
+            self.sock = self._connect()
+        # sendall() does not say how much it sent before failing, which decides whether the job can be retried
+        view = memoryview(data)
+        sent = 0
+        try:
+            while sent < len(data):
+                sent += self.sock.send(view[sent:])
+        except OSError as e:
+            self.close()
+            if sent:
+                raise PartialWriteError("{}:{}".format(self.host, self.port), sent, len(data)) from e
+            raise
+
+    def close(self) -> None:
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            finally:
+                self.sock = None
+
+
+class FileTransport(PrinterTransport):
+    """Writes the jobs to {printer_name}.txt instead of printing
+
+    The file is started afresh when the transport first writes, and every job sent through the transport is
+    appended to it."""
+    def __init__(self, printer_name: str):
+        self.filename = "{}.txt".format(printer_name.replace(RAW_PREFIX, '').replace(':', '_'))
+        self.file = None
+
+    def write(self, zpl_code: str) -> None:
+        if self.file is None:
+            self.file = open(self.filename, 'w')
+        self.file.write(zpl_code)
+        self.file.flush()
+
+    def close(self) -> None:
+        if self.file is not None:
+            try:
+                self.file.close()
+            finally:
+                self.file = None
+
+
+def parse_raw_address(printer_name: str) -> tuple[str, int]:
+    host, _, port = printer_name[len(RAW_PREFIX):].rpartition(':')
+    if not host or not port.isdigit():
+        return printer_name[len(RAW_PREFIX):], RAW_PORT
+    return host, int(port)
+
+
+def raw_printer_name(address: str) -> str:
+    """Normalise host or host:port to a tcp:// printer name"""
+    if not address.startswith(RAW_PREFIX):
+        address = RAW_PREFIX + address
+    host, port = parse_raw_address(address)
+    return "{}{}:{}".format(RAW_PREFIX, host, port)
+
+
+def open_transport(printer_name: str, debug: bool = False) -> PrinterTransport:
+    if debug:
+        return FileTransport(printer_name)
+    if printer_name.startswith(RAW_PREFIX):
+        return RawSocketTransport(*parse_raw_address(printer_name))
+    return Win32SpoolerTransport(printer_name)
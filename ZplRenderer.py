@@ -0,0 +1,271 @@
+"""
+Local rasterizer for the subset of ZPL produced by label_zpl.
+
+Supports ^XA, ^LH, ^BY, ^FO, ^BC (Code 128), ^A0, ^GB, ^FD, ^FS, ^PQ and ^XZ
+and returns a grayscale PNG, so label previews do not need the Labelary API.
+Anything outside that subset raises ZplRenderError so the caller can fall
+back to Labelary.
+"""
+import struct
+import zlib
+
+
+class ZplRenderError(Exception):
+    pass
+
+
+# Code 128 bar/space widths indexed by symbol value (103-105 are start A/B/C, 106 is stop)
+CODE128_PATTERNS = [
+    "212222", "222122", "222221", "121223", "121322", "131222", "122213", "122312", "132212", "221213",
+    "221312", "231212", "112232", "122132", "122231", "113222", "123122", "123221", "223211", "221132",
+    "221231", "213212", "223112", "312131", "311222", "321122", "321221", "312212", "322112", "322211",
+    "212123", "212321", "232121", "111323", "131123", "131321", "112313", "132113", "132311", "211313",
+    "231113", "231311", "112133", "112331", "132131", "113123", "113321", "133121", "313121", "211331",
+    "231131", "213113", "213311", "213131", "311123", "311321", "331121", "312113", "312311", "332111",
+    "314111", "221411", "431111", "111224", "111422", "121124", "121421", "141122", "141221", "112214",
+    "112412", "122114", "122411", "142112", "142211", "241211", "221114", "413111", "241112", "134111",
+    "111242", "121142", "121241", "114212", "124112", "124211", "411212", "421112", "421211", "212141",
+    "214121", "412121", "111143", "111341", "131141", "114113", "114311", "411113", "411311", "113141",
+    "114131", "311141", "411131", "211412", "211214", "211232", "2331112",
+]
+START_A, START_B, START_C, STOP = 103, 104, 105, 106
+
+# 5x7 bitmap glyphs used to approximate the scalable ^A0 font
+FONT_5X7 = {
+    "0": ("01110", "10001", "10011", "10101", "11001", "10001", "01110"),
+    "1": ("00100", "01100", "00100", "00100", "00100", "00100", "01110"),
+    "2": ("01110", "10001", "00001", "00010", "00100", "01000", "11111"),
+    "3": ("11111", "00010", "00100", "00010", "00001", "10001", "01110"),
+    "4": ("00010", "00110", "01010", "10010", "11111", "00010", "00010"),
+    "5": ("11111", "10000", "11110", "00001", "00001", "10001", "01110"),
+    "6": ("00110", "01000", "10000", "11110", "10001", "10001", "01110"),
+    "7": ("11111", "00001", "00010", "00100", "01000", "01000", "01000"),
+    "8": ("01110", "10001", "10001", "01110", "10001", "10001", "01110"),
+    "9": ("01110", "10001", "10001", "01111", "00001", "00010", "01100"),
+    "A": ("01110", "10001", "10001", "11111", "10001", "10001", "10001"),
+    "B": ("11110", "10001", "10001", "11110", "10001", "10001", "11110"),
+    "C": ("01110", "10001", "10000", "10000", "10000", "10001", "01110"),
+    "D": ("11100", "10010", "10001", "10001", "10001", "10010", "11100"),
+    "E": ("11111", "10000", "10000", "11110", "10000", "10000", "11111"),
+    "F": ("11111", "10000", "10000", "11110", "10000", "10000", "10000"),
+    "G": ("01110", "10001", "10000", "10111", "10001", "10001", "01111"),
+    "H": ("10001", "10001", "10001", "11111", "10001", "10001", "10001"),
+    "I": ("01110", "00100", "00100", "00100", "00100", "00100", "01110"),
+    "J": ("00111", "00010", "00010", "00010", "00010", "10010", "01100"),
+    "K": ("10001", "10010", "10100", "11000", "10100", "10010", "10001"),
+    "L": ("10000", "10000", "10000", "10000", "10000", "10000", "11111"),
+    "M": ("10001", "11011", "10101", "10101", "10001", "10001", "10001"),
+    "N": ("10001", "10001", "11001", "10101", "10011", "10001", "10001"),
+    "O": ("01110", "10001", "10001", "10001", "10001", "10001", "01110"),
+    "P": ("11110", "10001", "10001", "11110", "10000", "10000", "10000"),
+    "Q": ("01110", "10001", "10001", "10001", "10101", "10010", "01101"),
+    "R": ("11110", "10001", "10001", "11110", "10100", "10010", "10001"),
+    "S": ("01111", "10000", "10000", "01110", "00001", "00001", "11110"),
+    "T": ("11111", "00100", "00100", "00100", "00100", "00100", "00100"),
+    "U": ("10001", "10001", "10001", "10001", "10001", "10001", "01110"),
+    "V": ("10001", "10001", "10001", "10001", "10001", "01010", "00100"),
+    "W": ("10001", "10001", "10001", "10101", "10101", "10101", "01010"),
+    "X": ("10001", "10001", "01010", "00100", "01010", "10001", "10001"),
+    "Y": ("10001", "10001", "10001", "01010", "00100", "00100", "00100"),
+    "Z": ("11111", "00001", "00010", "00100", "01000", "10000", "11111"),
+    "*": ("00000", "00100", "10101", "01110", "10101", "00100", "00000"),
+    "-": ("00000", "00000", "00000", "11111", "00000", "00000", "00000"),
+    ".": ("00000", "00000", "00000", "00000", "00000", "01100", "01100"),
+    "/": ("00000", "00001", "00010", "00100", "01000", "10000", "00000"),
+    "=": ("00000", "00000", "11111", "00000", "11111", "00000", "00000"),
+    ":": ("00000", "01100", "01100", "00000", "01100", "01100", "00000"),
+    "?": ("01110", "10001", "00001", "00010", "00100", "00000", "00100"),
+    " ": ("00000", "00000", "00000", "00000", "00000", "00000", "00000"),
+}
+
+# Labelary sizes labels from the nominal printer resolution rather than dpmm * 25.4
+DPMM_TO_DPI = {6: 152, 8: 203, 12: 300, 24: 600}
+# the largest label and density Labelary renders, which also bounds the canvas memory of a preview
+MAX_LABEL_INCHES = 15.0
+MAX_DPMM = 24
+
+
+class Canvas:
+    def __init__(self, width: int, height: int):
+        self.width = width
+        self.height = height
+        self.pixels = bytearray(b'\xff' * (width * height))
+
+    def fill_rect(self, x: int, y: int, w: int, h: int) -> None:
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + w, self.width), min(y + h, self.height)
+        if x0 >= x1 or y0 >= y1:
+            return
+        run = bytes(x1 - x0)
+        for row in range(y0, y1):
+            start = row * self.width + x0
+            self.pixels[start:start + len(run)] = run
+
+    def to_png(self) -> bytes:
+        stride = self.width
+        raw = b''.join(b'\x00' + self.pixels[row * stride:(row + 1) * stride] for row in range(self.height))
+
+        def chunk(tag: bytes, data: bytes) -> bytes:
+            return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data))
+
+        header = struct.pack('>IIBBBBB', self.width, self.height, 8, 0, 0, 0, 0)
+        return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) +
+                chunk(b'IDAT', zlib.compress(raw, 6)) + chunk(b'IEND', b''))
+
+
+def code128_symbols(data: str) -> list[int]:
+    """Encode field data as Code 128 symbol values including start, check and stop symbols"""
+    subset = START_B
+    if data.startswith('>;'):
+        subset, data = START_C, data[2:]
+    elif data.startswith('>9'):
+        subset, data = START_A, data[2:]
+    elif data.startswith('>:'):
+        data = data[2:]
+    symbols = [subset]
+    if subset == START_C:
+        if len(data) % 2 != 0 or not data.isdigit():
+            raise ZplRenderError("Subset C data must be an even number of digits")
+        symbols.extend(int(data[i:i + 2]) for i in range(0, len(data), 2))
+    else:
+        for char in data:
+            code = ord(char)
+            if subset == START_B and 32 <= code <= 127:
+                symbols.append(code - 32)
+            elif subset == START_A and 32 <= code <= 95:
+                symbols.append(code - 32)
+            elif subset == START_A and code < 32:
+                symbols.append(code + 64)
+            else:
+                raise ZplRenderError("Character {!r} cannot be encoded in Code 128".format(char))
+    check = symbols[0] + sum(index * value for index, value in enumerate(symbols[1:], start=1))
+    symbols.append(check % 103)
+    symbols.append(STOP)
+    return symbols
+
+
+def draw_code128(canvas: Canvas, x: int, y: int, data: str, module_width: int, height: int) -> None:
+    for symbol in code128_symbols(data):
+        bar = True
+        for width in CODE128_PATTERNS[symbol]:
+            span = int(width) * module_width
+            if bar:
+                canvas.fill_rect(x, y, span, height)
+            x += span
+            bar = not bar
+
+
+def draw_text(canvas: Canvas, x: int, y: int, text: str, height: int, width: int) -> None:
+    advance = width if width > 0 else round(height * 0.45)
+    glyph_width = max(advance * 5 // 6, 1)
+    for char in text:
+        glyph = FONT_5X7.get(char.upper(), FONT_5X7['?'])
+        for row, bits in enumerate(glyph):
+            top = y + row * height // 7
+            bottom = y + (row + 1) * height // 7
+            for col, bit in enumerate(bits):
+                if bit == '1':
+                    left = x + col * glyph_width // 5
+                    right = x + (col + 1) * glyph_width // 5
+                    canvas.fill_rect(left, top, right - left, bottom - top)
+        x += advance
+
+
+def draw_box(canvas: Canvas, x: int, y: int, w: int, h: int, thickness: int) -> None:
+    w, h = max(w, thickness), max(h, thickness)
+    canvas.fill_rect(x, y, w, thickness)
+    canvas.fill_rect(x, y + h - thickness, w, thickness)
+    canvas.fill_rect(x, y, thickness, h)
+    canvas.fill_rect(x + w - thickness, y, thickness, h)
+
+
+def _int_params(params: str, defaults: list[int]) -> list[int]:
+    values = params.split(',')
+    result = []
+    for index, default in enumerate(defaults):
+        value = values[index].strip() if index < len(values) else ''
+        if value == '':
+            result.append(default)
+        elif value.lstrip('-').isdigit():
+            result.append(int(value))
+        else:
+            raise ZplRenderError("Unsupported parameter {!r}".format(value))
+    return result
+
+
+def label_size(dpmm: int | str, width: float | str, height: float | str) -> tuple[int, int]:
+    """Return the label size in dots for a print density and a width/height in inches"""
+    try:
+        dpmm, width, height = int(dpmm), float(width), float(height)
+    except ValueError as e:
+        raise ZplRenderError(str(e))
+    if dpmm > MAX_DPMM or not (width <= MAX_LABEL_INCHES and height <= MAX_LABEL_INCHES):  # also rejects nan
+        raise ZplRenderError("Labels are limited to {} dpmm and {}x{} inches".format(
+            MAX_DPMM, MAX_LABEL_INCHES, MAX_LABEL_INCHES))
+    dpi = DPMM_TO_DPI.get(dpmm, round(dpmm * 25.4))
+    return int(width * dpi), int(height * dpi)
+
+
+def render_zpl(zpl: str, dpmm: int | str = 8, width: float | str = 3, height: float | str = 1.5) -> Canvas:
+    """Rasterize the first label in a ZPL script onto a canvas"""
+    label_width, label_height = label_size(dpmm, width, height)
+    if label_width <= 0 or label_height <= 0:
+        raise ZplRenderError("Label size must be positive")
+    canvas = Canvas(label_width, label_height)
+    home_x, home_y = 0, 0
+    module_width, bar_height = 2, 10
+    field_x, field_y = 0, 0
+    field: tuple | None = None
+    field_data = ''
+    for command in zpl.split('^')[1:]:
+        command = command.strip('\r\n')
+        if command[:1].upper() == 'A' and command[1:2] != '@':
+            code, params = 'A', command[1:]
+        else:
+            code, params = command[:2].upper(), command[2:]
+        if code == 'XA' or code == 'PQ':
+            continue
+        elif code == 'XZ':
+            break
+        elif code == 'LH':
+            home_x, home_y = _int_params(params, [home_x, home_y])
+        elif code == 'BY':
+            values = params.split(',')
+            values[1:2] = ['']  # wide to narrow ratio does not apply to Code 128
+            module_width, _, bar_height = _int_params(','.join(values), [module_width, 3, bar_height])
+        elif code == 'FO':
+            field_x, field_y = _int_params(params, [0, 0])
+        elif code == 'BC':
+            values = params.split(',')
+            if len(values) > 0 and values[0] not in ('', 'N'):
+                raise ZplRenderError("Unsupported ^BC orientation")
+            height_param = _int_params(','.join(values[1:2]), [bar_height])[0]
+            field = ('BC', height_param)
+        elif code == 'A':
+            font, _, sizes = params.partition(',')
+            if font[:1] != '0' or font[1:] not in ('', 'N'):
+                raise ZplRenderError("Unsupported font {!r}".format(font))
+            font_height, font_width = _int_params(sizes, [15, 0])
+            field = ('A', font_height, font_width)
+        elif code == 'GB':
+            box_width, box_height, thickness = _int_params(params, [1, 1, 1])
+            field = ('GB', box_width, box_height, thickness)
+        elif code == 'FD':
+            field_data = params
+        elif code == 'FS':
+            x, y = home_x + field_x, home_y + field_y
+            if field is not None and field[0] == 'BC':
+                draw_code128(canvas, x, y, field_data, module_width, field[1])
+            elif field is not None and field[0] == 'A':
+                draw_text(canvas, x, y, field_data, field[1], field[2])
+            elif field is not None and field[0] == 'GB':
+                draw_box(canvas, x, y, field[1], field[2], field[3])
+            field, field_data = None, ''
+        else:
+            raise ZplRenderError("Unsupported ZPL command ^{}".format(code))
+    return canvas
+
+
+def render_zpl_png(zpl: str, dpmm: int | str = 8, width: float | str = 3, height: float | str = 1.5) -> bytes:
+    """Render ZPL to PNG bytes at the given density (dots per mm) and label size (inches)"""
+    return render_zpl(zpl, dpmm, width, height).to_png()
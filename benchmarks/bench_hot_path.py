@@ -0,0 +1,227 @@
+"""
+Benchmarks for the scan-to-label hot path.
+
+Runs on any platform: win32print is replaced by benchmarks/fake_win32print.py
+and Labelary by a local HTTP server (benchmarks/fake_labelary.py). The
+end-to-end benchmarks drive the real page through NiceGUI's User test
+harness: they set the input and press Enter as a scanner would.
+
+    python benchmarks/bench_hot_path.py --output results.json
+    python benchmarks/bench_hot_path.py --compare results.json
+
+Results are written as JSON so runs can be compared over time. Latencies
+exclude the fixed debounce_delay and scan key interval, which are set to 0
+for the run and recorded separately.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from datetime import datetime, timezone
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+sys.path.insert(0, BENCHMARK_DIR)
+
+import fake_win32print  # noqa: E402
+sys.modules['win32print'] = fake_win32print
+# NiceGUI's User harness expects to run under pytest
+os.environ.setdefault('PYTEST_CURRENT_TEST', 'bench_hot_path')
+
+from nicegui import app  # noqa: E402
+from nicegui.testing import User  # noqa: E402
+from nicegui.testing.user_simulation import user_simulation  # noqa: E402
+
+import BCPrinter  # noqa: E402
+from Helpers import strip, validate_input, calc_check_character, CHECK_CHARACTERS, OutputBarcode  # noqa: E402
+from PreviewCache import PreviewCache, preview_key  # noqa: E402
+from ScanDetector import SCAN_KEY_INTERVAL  # noqa: E402
+from fake_labelary import FakeLabelaryServer  # noqa: E402
+
+
+def make_units(count: int, mode: int) -> list[str]:
+    """Distinct scanner-style unit numbers, with valid check flags in full unit number mode"""
+    units = []
+    for sequence in range(count):
+        din = 'G151723{:06d}'.format(sequence)
+        flags = str(60 + CHECK_CHARACTERS.index(calc_check_character(din))) if mode == 2 else '00'
+        units.append('=' + din + flags)
+    return units
+
+
+def summarise(samples: list[float]) -> dict[str, float]:
+    samples = sorted(samples)
+    return {
+        'n': len(samples),
+        'mean_us': statistics.fmean(samples) * 1e6,
+        'p50_us': samples[len(samples) // 2] * 1e6,
+        'p95_us': samples[min(int(len(samples) * 0.95), len(samples) - 1)] * 1e6,
+        'min_us': samples[0] * 1e6,
+    }
+
+
+def time_calls(function, inputs: list, repeat: int) -> dict[str, float]:
+    """Time batches of calls and report the per-call latency"""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for value in inputs:
+            function(value)
+        samples.append((time.perf_counter() - start) / len(inputs))
+    return summarise(samples)
+
+
+def make_session(mode: int) -> BCPrinter.Session:
+    session = BCPrinter.Session()
+    session.output_mode_selection = mode
+    return session
+
+
+def micro_benchmarks(units: list[str], mode: int, repeat: int) -> dict[str, dict]:
+    session = make_session(mode)
+    output_barcode = OutputBarcode('', mode)
+    results = {
+        'strip': time_calls(lambda text: strip(text, mode), units, repeat),
+        'validate_input': time_calls(lambda text: validate_input(text, mode), units, repeat),
+        'OutputBarcode.update': time_calls(lambda text: output_barcode.update(text, mode), units, repeat),
+        'format_barcode_string': time_calls(lambda text: BCPrinter.format_barcode_string(session, text), units,
+                                            repeat),
+        'parse_din': time_calls(lambda text: BCPrinter.current_din(session, text), units, repeat),
+        'print_zpl': time_calls(lambda text: BCPrinter.generate_print_zpl(session, [text]), units, repeat),
+    }
+    # the same unit number again, as when every binding re-reads the input value
+    results['parse_din (repeat input)'] = time_calls(
+        lambda text: BCPrinter.current_din(session, text), units[:1] * 100, repeat)
+    return results
+
+
+class RecordingSession(BCPrinter.Session):
+    """Session that keeps a reference to itself, so the benchmark can wait on the page's state"""
+    instances: list['RecordingSession'] = []
+
+    def __init__(self):
+        super().__init__()
+        RecordingSession.instances.append(self)
+
+
+async def wait_until(condition) -> None:
+    while not condition():
+        await asyncio.sleep(0)
+
+
+async def keystroke_to_preview(user: User, session: BCPrinter.Session, units: list[str]) -> dict[str, float]:
+    """Input change to PNG bytes: the input's change handler through to fetching /preview/<key>"""
+    samples = []
+    for text in units:
+        din = BCPrinter.current_din(session, text)
+        source = '/preview/' + preview_key(din.zpl, session.dpmm, session.width, session.height,
+                                           BCPrinter.preview_backend)
+        start = time.perf_counter()
+        session.user_input.set_value(text)
+        await wait_until(lambda: session.zpl_preview_source == source)
+        response = await user.http_client.get(source)
+        samples.append(time.perf_counter() - start)
+        assert response.status_code == 200, 'preview render failed'
+    return summarise(samples)
+
+
+async def enter_to_spool(user: User, session: BCPrinter.Session, units: list[str]) -> dict[str, float]:
+    """Enter key to the job being written to the spooler: handle_key_enter, send_zpl_to_printer, print worker"""
+    samples = []
+    for text in units:
+        session.user_input.set_value(text)
+        await wait_until(lambda: session.text == text)
+        written = sum(fake_win32print.bytes_written.values())
+        start = time.perf_counter()
+        user.find('Unit Number').trigger('keydown.enter')
+        await wait_until(lambda: sum(fake_win32print.bytes_written.values()) > written)
+        samples.append(time.perf_counter() - start)
+        assert session.user_input.value == '', 'label was not printed'
+    return summarise(samples)
+
+
+async def end_to_end_benchmarks(units: list[str], mode: int) -> dict[str, dict]:
+    results = {}
+    BCPrinter.Session = RecordingSession
+    # the harness resets NiceGUI's routes, the app's own are put back once it has started
+    routes = [route for route in app.routes if getattr(route, 'endpoint', None) is not None
+              and route.endpoint.__module__ == BCPrinter.__name__]
+    async with user_simulation(root=BCPrinter.root) as user:
+        app.router.routes.extend(routes)
+        await user.open('/')
+        session = RecordingSession.instances[-1]
+        session.scan_detector.key_interval = 0
+        session.output_mode_selection = mode
+        for backend in ('local', 'labelary'):
+            BCPrinter.preview_backend = backend
+            BCPrinter.preview_cache = PreviewCache()
+            results[f'keystroke_to_preview[{backend}, cold]'] = await keystroke_to_preview(user, session, units)
+            results[f'keystroke_to_preview[{backend}, cached]'] = await keystroke_to_preview(user, session, units)
+        results['enter_to_spool'] = await enter_to_spool(user, session, units)
+    await BCPrinter.labelary.close()
+    return results
+
+
+def run(args) -> dict:
+    fake_win32print.SPOOLER_CALL_SECONDS = args.spooler_delay
+    units = make_units(args.units, args.mode)
+    results = micro_benchmarks(units, args.mode, args.repeat)
+    debounce_delay = BCPrinter.debounce_delay
+    BCPrinter.debounce_delay = 0.0
+    with FakeLabelaryServer(args.labelary_delay) as labelary:
+        BCPrinter.labelary.url = labelary.url
+        results.update(asyncio.run(end_to_end_benchmarks(units[:args.e2e_units], args.mode)))
+    BCPrinter.print_workers.stop()
+    return {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': {
+            'mode': args.mode, 'units': args.units, 'e2e_units': args.e2e_units, 'repeat': args.repeat,
+            'spooler_delay_s': args.spooler_delay, 'labelary_delay_s': args.labelary_delay,
+            'debounce_delay_s': debounce_delay, 'scan_key_interval_s': SCAN_KEY_INTERVAL,
+        },
+        'results': results,
+    }
+
+
+def compare(current: dict, baseline: dict) -> None:
+    print('{:<45} {:>12} {:>12} {:>8}'.format('benchmark', 'baseline us', 'current us', 'ratio'))
+    for name, result in current['results'].items():
+        before = baseline['results'].get(name)
+        if before is None:
+            print('{:<45} {:>12} {:>12.2f} {:>8}'.format(name, '-', result['mean_us'], '-'))
+        else:
+            print('{:<45} {:>12.2f} {:>12.2f} {:>8.2f}'.format(
+                name, before['mean_us'], result['mean_us'], result['mean_us'] / before['mean_us']))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', type=int, choices=[1, 2, 3], default=2, help='output mode (default: 2)')
+    parser.add_argument('--units', type=int, default=5000, help='distinct unit numbers for microbenchmarks')
+    parser.add_argument('--e2e-units', type=int, default=200, help='unit numbers for end-to-end runs')
+    parser.add_argument('--repeat', type=int, default=5, help='repeats of each microbenchmark')
+    parser.add_argument('--spooler-delay', type=float, default=0.0, help='seconds per fake spooler call')
+    parser.add_argument('--labelary-delay', type=float, default=0.0, help='seconds per fake Labelary response')
+    parser.add_argument('-o', '--output', help='write the JSON results to this file instead of stdout')
+    parser.add_argument('--compare', metavar='BASELINE', help='compare against a previous JSON results file')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    arguments = parse_args()
+    report = run(arguments)
+    if arguments.output:
+        with open(arguments.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    elif not arguments.compare:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    if arguments.compare:
+        with open(arguments.compare) as f:
+            compare(report, json.load(f))
@@ -0,0 +1,123 @@
+"""
+Check RawSocketTransport against a local stand-in printer (benchmarks/fake_zebra.py).
+
+Covers reusing the connection between jobs, noticing a connection the printer
+has closed and reconnecting before the next job, failing without resending
+when the printer cannot be reached, and the print worker not resending a job
+the connection was lost part way through. Exits non-zero if a check fails:
+
+    python benchmarks/check_raw_transport.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from PrintQueue import PrintWorker  # noqa: E402
+from Transports import PartialWriteError, RawSocketTransport, open_transport  # noqa: E402
+from fake_zebra import FakeZebraPrinter  # noqa: E402
+
+LABEL = '^XA^FO50,50^A0N,30^FD{}^FS^XZ'
+
+
+class CountingTransport(RawSocketTransport):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.connects: int = 0
+
+    def _connect(self):
+        self.connects += 1
+        return super()._connect()
+
+
+def wait_for(condition, timeout: float = 2.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def check_reuses_connection() -> None:
+    with FakeZebraPrinter() as printer:
+        transport = open_transport(printer.address)
+        expected = (LABEL.format(1) + LABEL.format(2)).encode()
+        transport.write(LABEL.format(1))
+        transport.write(LABEL.format(2))
+        assert wait_for(lambda: printer.data == expected), printer.received
+        assert len(printer.received) == 1, 'expected one connection, got {}'.format(len(printer.received))
+        transport.close()
+
+
+def check_reconnects_after_printer_closes() -> None:
+    with FakeZebraPrinter() as printer:
+        host, port = printer.address[len('tcp://'):].rsplit(':', 1)
+        transport = CountingTransport(host, int(port))
+        transport.write(LABEL.format(1))
+        assert wait_for(lambda: printer.data == LABEL.format(1).encode())
+        printer.drop_connections()
+        assert wait_for(transport._is_stale), 'closed connection was not detected'
+        transport.write(LABEL.format(2))
+        assert wait_for(lambda: printer.data == (LABEL.format(1) + LABEL.format(2)).encode()), printer.received
+        assert transport.connects == 2, 'expected one reconnect, got {}'.format(transport.connects - 1)
+        transport.close()
+
+
+def check_fails_without_resending() -> None:
+    with FakeZebraPrinter() as printer:
+        host, port = printer.address[len('tcp://'):].rsplit(':', 1)
+        transport = CountingTransport(host, int(port))
+        transport.write(LABEL.format(1))
+        assert wait_for(lambda: printer.data == LABEL.format(1).encode())
+    # the printer is gone: the job fails after one connection attempt and is left to the print worker to retry
+    assert wait_for(transport._is_stale), 'closed connection was not detected'
+    try:
+        transport.write(LABEL.format(2))
+    except OSError:
+        pass
+    else:
+        raise AssertionError('write to a printer that is offline succeeded')
+    assert transport.connects == 2, 'expected a single reconnect attempt, got {}'.format(transport.connects - 1)
+    assert transport.sock is None
+
+
+def check_no_resend_after_partial_write() -> None:
+    # a batch larger than the socket buffers, so the reset arrives while it is still being sent
+    batch = ''.join(LABEL.format(index) for index in range(200000))
+    with FakeZebraPrinter(close_after=64 * 1024) as printer:
+        connects = []
+
+        def open_counted(printer_name, debug):
+            connects.append(printer_name)
+            return open_transport(printer_name, debug)
+        worker = PrintWorker(open_counted, retry_delay=0)
+        try:
+            worker.submit(batch, printer.address).result(timeout=10)
+        except PartialWriteError:
+            pass
+        else:
+            raise AssertionError('a job cut off part way through reported success')
+        finally:
+            worker.stop()
+        assert len(connects) == 1, 'the job was resent {} times'.format(len(connects) - 1)
+        assert len(printer.received) == 1, 'expected one connection, got {}'.format(len(printer.received))
+
+
+def main() -> int:
+    failed = 0
+    for check in (check_reuses_connection, check_reconnects_after_printer_closes, check_fails_without_resending,
+                  check_no_resend_after_partial_write):
+        try:
+            check()
+            print('ok     {}'.format(check.__name__))
+        except AssertionError as e:
+            failed += 1
+            print('FAILED {}: {}'.format(check.__name__, e))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,62 @@
+"""
+Local stand-in for the Labelary API.
+
+Answers POST /v1/printers/{dpmm}dpmm/labels/{width}x{height}/0/ with a PNG
+rendered by ZplRenderer after an optional artificial delay.
+"""
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from ZplRenderer import render_zpl_png
+
+URL_PATTERN = re.compile(r'/v1/printers/(\d+)dpmm/labels/([\d.]+)x([\d.]+)/0/')
+
+
+class FakeLabelaryServer:
+    def __init__(self, delay: float = 0.0):
+        self.delay = delay
+        self.requests: int = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                server.requests += 1
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+                match = URL_PATTERN.fullmatch(self.path)
+                if server.delay > 0:
+                    time.sleep(server.delay)
+                if match is None:
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                png = render_zpl_png(body, *match.groups())
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/png')
+                self.send_header('Content-Length', str(len(png)))
+                self.end_headers()
+                self.wfile.write(png)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        """URL template in the form LabelaryService.url expects"""
+        host, port = self.httpd.server_address[:2]
+        return 'http://{}:{}/v1/printers/{{}}dpmm/labels/{{}}x{{}}/0/'.format(host, port)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,64 @@
+"""
+Stand-in for pywin32's win32print so the print path can be benchmarked on Linux.
+
+Each spooler call sleeps for SPOOLER_CALL_SECONDS to model spooler overhead,
+and the bytes written to each printer are counted.
+"""
+import time
+
+PRINTER_ENUM_LOCAL = 2
+PRINTER_ENUM_CONNECTIONS = 4
+SPOOLER_CALL_SECONDS = 0.0
+PRINTERS = ["Fake Zebra"]
+
+bytes_written: dict[str, int] = {}
+open_handles: int = 0
+
+
+def _spooler_call():
+    if SPOOLER_CALL_SECONDS > 0:
+        time.sleep(SPOOLER_CALL_SECONDS)
+
+
+def GetDefaultPrinter() -> str:
+    return PRINTERS[0]
+
+
+def EnumPrinters(flags: int):
+    _spooler_call()
+    return [(0, "", name, "") for name in PRINTERS]
+
+
+def OpenPrinter(printer_name: str) -> str:
+    global open_handles
+    _spooler_call()
+    open_handles += 1
+    return printer_name
+
+
+def ClosePrinter(handle: str) -> None:
+    global open_handles
+    open_handles -= 1
+
+
+def StartDocPrinter(handle: str, level: int, info: tuple) -> int:
+    _spooler_call()
+    return 1
+
+
+def StartPagePrinter(handle: str) -> None:
+    _spooler_call()
+
+
+def WritePrinter(handle: str, data: bytes) -> int:
+    _spooler_call()
+    bytes_written[handle] = bytes_written.get(handle, 0) + len(data)
+    return len(data)
+
+
+def EndPagePrinter(handle: str) -> None:
+    _spooler_call()
+
+
+def EndDocPrinter(handle: str) -> None:
+    _spooler_call()
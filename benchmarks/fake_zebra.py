@@ -0,0 +1,86 @@
+"""
+Local stand-in for a Zebra printer's raw port (9100).
+
+Accepts TCP connections and records the bytes received on each one.
+drop_connections() closes the open connections from the printer side, as a
+printer does after an idle timeout or a power cycle. With close_after, each
+connection is reset once that many bytes have arrived, as when a printer is
+switched off part way through a job.
+"""
+import socket
+import threading
+
+
+class FakeZebraPrinter:
+    def __init__(self, port: int = 0, close_after: int | None = None):
+        self.close_after = close_after
+        self.listener = socket.create_server(('127.0.0.1', port))
+        # a blocked accept() is not woken by close() on every platform, so the accept loop polls
+        self.listener.settimeout(0.05)
+        self.closed = threading.Event()
+        self.connections: list[socket.socket] = []
+        self.received: list[bytes] = []  # bytes received, one entry per connection
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._accept, daemon=True)
+
+    @property
+    def address(self) -> str:
+        """Printer name in the form open_transport expects"""
+        host, port = self.listener.getsockname()[:2]
+        return 'tcp://{}:{}'.format(host, port)
+
+    @property
+    def data(self) -> bytes:
+        with self.lock:
+            return b''.join(self.received)
+
+    def _accept(self) -> None:
+        while not self.closed.is_set():
+            try:
+                connection, _ = self.listener.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                return  # listener closed
+            connection.settimeout(None)
+            with self.lock:
+                self.connections.append(connection)
+                index = len(self.received)
+                self.received.append(b'')
+            threading.Thread(target=self._receive, args=(connection, index), daemon=True).start()
+
+    def _receive(self, connection: socket.socket, index: int) -> None:
+        while True:
+            try:
+                chunk = connection.recv(65536)
+            except OSError:
+                return
+            if not chunk:
+                return
+            with self.lock:
+                self.received[index] += chunk
+                cut_off = self.close_after is not None and len(self.received[index]) >= self.close_after
+            if cut_off:
+                # closing with unread data resets the connection, so the sender sees the failure
+                connection.close()
+                return
+
+    def drop_connections(self) -> None:
+        with self.lock:
+            connections, self.connections = self.connections, []
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            connection.close()
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.closed.set()
+        self.thread.join()
+        self.listener.close()
+        self.drop_connections()